@@ -0,0 +1,167 @@
+# Runs the actions of evaluated commands in a thread of their own, so that
+# slow ones (subprocesses, long text entry, repetitions) don't hold up the
+# reading and matching of the lines that come after them.
+#
+# Jobs (typically one per line) run one at a time, in the order they were
+# submitted. Canceling skips whatever actions haven't run yet, including
+# the remaining ones of the job that is running.
+
+import queue
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+class Executor:
+    # runs jobs right away (in the caller's thread) until started
+
+    def __init__(self) -> None:
+        self.jobs: queue.Queue = queue.Queue()
+        self.thread: Optional[threading.Thread] = None
+        self.generation = 0 # bumped by cancel()
+        self.running_generation = 0
+        self.depth = 0 # jobs submitted but not yet finished
+        self.max_depth = 0
+        self.durations: Dict[str, Tuple[int, float, float]] = {} # runs, total and max seconds, by action
+        self.exit: Optional[SystemExit] = None
+        self.lock = threading.Lock()
+
+    def start(self, on_exit: Callable[[], None], on_error: Callable[[Exception], None]) -> None:
+        # on_exit is called in the executor thread if an action exits, and
+        # on_error if a job fails (after which the next one runs as usual)
+        self.on_exit = on_exit
+        self.on_error = on_error
+        self.thread = threading.Thread(target=self.work, daemon=True)
+        self.thread.start()
+
+    def submit(self, job: Callable[[], None]) -> None:
+        if self.thread is None:
+            self.running_generation = self.generation
+            job()
+            return
+        if self.exit is not None: return
+        with self.lock:
+            self.depth += 1
+            self.max_depth = max(self.max_depth, self.depth)
+        self.jobs.put((self.generation, job))
+
+    def cancel(self) -> None:
+        self.generation += 1
+
+    def canceled(self) -> bool:
+        # whether the running job should stop
+        return self.running_generation != self.generation
+
+    def wait(self) -> None:
+        self.jobs.join()
+
+    def work(self) -> None:
+        while True:
+            self.running_generation, job = self.jobs.get()
+            try:
+                job()
+            except SystemExit as e: # e.g. 'shutdown commander'
+                self.exit = e
+                self.cancel()
+                self.on_exit()
+            except Exception as e:
+                self.on_error(e)
+            finally:
+                with self.lock: self.depth -= 1
+                self.jobs.task_done()
+
+    def run_action(self, ctx: Dict[str, Any], f: Callable, args: List[str]) -> None:
+        ctx['canceled'] = self.canceled # for actions that run more actions
+        start = time.perf_counter()
+        try:
+            f(ctx, *args)
+        finally:
+            took = time.perf_counter() - start
+            name = getattr(f, '__name__', '?')
+            with self.lock:
+                runs, total, worst = self.durations.get(name, (0, 0.0, 0.0))
+                self.durations[name] = (runs + 1, total + took, max(worst, took))
+
+    def statistics(self) -> str:
+        with self.lock:
+            lines = ['queue depth ' + str(self.depth) + ', max ' + str(self.max_depth)]
+            for name, (runs, total, worst) in sorted(self.durations.items()):
+                lines.append(name + ': ' + str(runs) + ' runs, mean %.3f ms, max %.3f ms' % (total / runs * 1000, worst * 1000))
+        return '\n'.join(lines)
+
+class Job:
+
+    def __init__(self, n: int, description: str) -> None:
+        self.n = n
+        self.description = description
+        self.state = 'queued' # then running, and then finished, canceled or failed
+        self.submitted = time.monotonic()
+        self.started: Optional[float] = None
+        self.ended: Optional[float] = None
+        self.cancel_requested = False
+
+    def canceled(self) -> bool:
+        return self.cancel_requested
+
+class Scheduler:
+    # runs jobs concurrently on a bounded number of threads, keeping a table
+    # of the ones that haven't ended, and counts of the ones that have
+
+    def __init__(self, workers: int) -> None:
+        import concurrent.futures
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='job')
+        self.lock = threading.Lock()
+        self.jobs: Dict[int, Job] = {} # queued and running ones
+        self.next_nr = 0
+        self.ended: Dict[str, Tuple[int, float]] = {} # number and total seconds run, by final state
+
+    def submit(self, description: str, run: Callable[[Job], None]) -> Job:
+        # run should return early once the job is canceled (even before it
+        # started); if it raises, the job failed
+        with self.lock:
+            job = Job(self.next_nr, description)
+            self.next_nr += 1
+            self.jobs[job.n] = job
+        self.pool.submit(self.work, job, run)
+        return job
+
+    def work(self, job: Job, run: Callable[[Job], None]) -> None:
+        with self.lock:
+            job.state = 'running'
+            job.started = time.monotonic()
+        try:
+            run(job)
+            state = ('canceled' if job.cancel_requested else 'finished')
+        except Exception:
+            state = 'failed'
+        with self.lock: self.end(job, state)
+
+    def end(self, job: Job, state: str) -> None:
+        # with self.lock held
+        job.state = state
+        job.ended = time.monotonic()
+        n, total = self.ended.get(state, (0, 0.0))
+        self.ended[state] = (n + 1, total + (0.0 if job.started is None else job.ended - job.started))
+        del self.jobs[job.n]
+
+    def cancel(self, n: int) -> bool:
+        with self.lock:
+            if n not in self.jobs: return False
+            self.jobs[n].cancel_requested = True
+            return True
+
+    def is_active(self, n: int) -> bool:
+        with self.lock: return n in self.jobs
+
+    def describe(self) -> List[str]:
+        # a consistent snapshot, even while jobs come and go
+        with self.lock:
+            now = time.monotonic()
+            lines = []
+            for n, job in sorted(self.jobs.items()):
+                since = (job.submitted if job.started is None else job.started)
+                lines.append(str(n) + ': ' + job.state + ' for %.1f s: ' % (now - since) + job.description)
+            if not lines: lines.append('No active jobs.')
+            if self.ended:
+                lines.append(', '.join(str(k) + ' ' + state + ' (%.3f s)' % total
+                                       for state, (k, total) in sorted(self.ended.items())))
+        return lines
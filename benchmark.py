@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+
+# Measures how long matching command chains of various lengths takes,
+# and how much memory it allocates (as traced by tracemalloc), as well as
+# how long evaluating deeply nested aliases, expanding long alias bodies and
+# tokenizing long braced commands takes.
+
+import ecl
+import execute
+import sys
+import time
+import tracemalloc
+import util
+from typing import List
+
+def chain(n: int) -> List[str]:
+    words = (['press', 'a', ';'] * n)[:n]
+    if words[-1] == ';': words[-1] = 'a'
+    return words
+
+def among(n: int) -> List[str]:
+    # word <word> is among <word> <word>+ recurses once per word
+    return ['word', 'z', 'is', 'among'] + ['a'] * n
+
+def measure(e: ecl.Context, name: str, words: List[str], modes: List[ecl.Mode], runs: int) -> None:
+    start = time.perf_counter()
+    for _ in range(runs):
+        pr = e.match_commands(list(words), list(modes), True)
+    took = (time.perf_counter() - start) / runs
+    assert pr.longest == len(words) and not pr.missing and pr.error is None
+
+    tracemalloc.start()
+    e.match_commands(list(words), list(modes), True)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print('%-28s %8.2f ms, peak %7d KiB' % (name + ':', took * 1000, peak // 1024))
+
+def expand(e: ecl.Context, n: int, runs: int) -> None:
+    expansion = 'text "$1" ; press $0 ; ' * n
+    start = time.perf_counter()
+    for _ in range(runs):
+        e.substitute_variables(expansion, ['a', 'b "c"'], ['computer'])
+    took = (time.perf_counter() - start) / runs
+    print('%-28s %8.2f ms' % ('expansion of %d chars:' % len(expansion), took * 1000))
+
+def tokenize(n: int, runs: int) -> None:
+    s = '{ ' + 'text "a \\"b\\"" ; press { control c } ; ' * n + '}'
+    start = time.perf_counter()
+    for _ in range(runs):
+        util.try_parse_braced_expr(s)
+    took = (time.perf_counter() - start) / runs
+    print('%-28s %8.2f ms' % ('tokenizing %d chars:' % len(s), took * 1000))
+
+def main() -> None:
+    sys.setrecursionlimit(100000)
+    execute.configdir = 'example_config'
+    execute.color = False
+    execute.load_config()
+    e: ecl.Context = execute.eclc
+    for n in [5, 50, 500]:
+        measure(e, 'chain of %d words' % n, chain(n), ['computer'], 10 if n < 500 else 3)
+    for n in [10, 40]:
+        measure(e, 'nested aliases, %d words' % n, among(n), ['control'], 10)
+    for n in [10, 100, 1000]:
+        expand(e, n, 10)
+    for n in [10, 100, 1000]:
+        tokenize(n, 10)
+
+if __name__ == '__main__': main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+# Cross-checks the trie matching engine against the linear one on a large
+# synthetic config, and reports how long each took (on stderr, best of three).
+
+import ecl
+import eclbuiltins
+import random
+import sys
+import time
+from typing import Dict, List
+
+verbs = 'go delete select copy move open close find show mark'.split()
+objects = 'word line file window tab page frame buffer match item'.split()
+modifiers = 'next previous first last this other'.split()
+enums = {
+    'direction': ecl.parse_pattern('left/right/up/down'),
+    'place': ecl.parse_pattern('<direction>/start of <object>/end of <object>'),
+    'object': ecl.parse_pattern('/'.join(objects)),
+}
+
+def synthetic_modes(rnd: random.Random, nmodes: int, naliases: int) -> Dict[ecl.Mode, Dict[str, str]]:
+    modes: Dict[ecl.Mode, Dict[str, str]] = {}
+    for i in range(nmodes):
+        aliases = {}
+        while len(aliases) < naliases:
+            words = [rnd.choice(verbs)]
+            for _ in range(rnd.randint(0, 3)):
+                words.append(rnd.choice(modifiers + objects + ['to', 'the', '<number>', '<direction>', '<place>']))
+            if rnd.random() < 0.1: words.append('<word>+')
+            if rnd.random() < 0.05: words.append('<command>')
+            aliases[' '.join(words)] = 'builtin print ' + str(i)
+        modes['mode' + str(i)] = aliases
+    return modes
+
+def synthetic_input(rnd: random.Random, raw: Dict[ecl.Mode, Dict[str, str]]) -> List[str]:
+    vocab = verbs + objects + modifiers + ['to', 'the', '3', '12', 'left', 'up', 'start', 'end', 'of', ';']
+    if rnd.random() < 0.3:
+        return [rnd.choice(vocab) for _ in range(rnd.randint(1, 8))]
+    # something close to an existing alias:
+    samples = {'<number>': '3', '<direction>': 'up', '<place>': 'end of line', '<word>+': 'hello world', '<command>': 'mark'}
+    alias = rnd.choice(list(rnd.choice(list(raw.values()))))
+    words = ' '.join([samples.get(w, w) for w in alias.split()]).split()
+    if rnd.random() < 0.3: words = words[:rnd.randint(1, len(words))]
+    if rnd.random() < 0.3: words += [rnd.choice(vocab)]
+    return words
+
+def describe(pr: ecl.ParseResult) -> str:
+    acts = [(getattr(f, '__name__', ''), a) for f, a in pr.actions]
+    return repr((pr.longest, pr.missing, pr.error, pr.new_mode, pr.resolved, pr.retval, acts))
+
+def main() -> None:
+    rnd = random.Random(1)
+    raw = synthetic_modes(rnd, 20, 150)
+    modes = dict([(m, ecl.parse_aliases(a)) for m, a in raw.items()])
+    e = ecl.Context(modes, enums)
+    e.color = False
+    e.builtin_commands = eclbuiltins.builtin_commands
+    e.pure_builtins = eclbuiltins.pure_builtins
+    e.global_builtins = eclbuiltins.global_builtins
+    e.builtin_types = eclbuiltins.builtin_types
+    e.compute_first_sets()
+    inputs = [synthetic_input(rnd, raw) for _ in range(1000)]
+    mode_sets = [rnd.sample(list(modes), 4) for _ in inputs]
+
+    # the engines take turns, and the best of three rounds counts, since timings are noisy
+    results = {}
+    best: Dict[bool, float] = {}
+    for _ in range(3):
+        for trie in [False, True]:
+            e.trie = trie
+            start = time.perf_counter()
+            results[trie] = [describe(e.match_commands(list(i), list(m))) for i, m in zip(inputs, mode_sets)]
+            best[trie] = min(best.get(trie, float('inf')), time.perf_counter() - start)
+    for trie in [False, True]:
+        print(('trie' if trie else 'linear') + ': %.3f s' % best[trie], file=sys.stderr)
+
+    bad = [i for i, (x, y) in enumerate(zip(results[False], results[True])) if x != y]
+    for i in bad:
+        print('engines disagree on:', ' '.join(inputs[i]))
+    print(str(len(inputs)) + ' utterances, ' + str(len(bad)) + ' disagreements')
+
+if __name__ == '__main__': main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+# Checks that confirm_input doesn't wait for its beeps, using fake sounds
+# that note when they're played: it should return long before they're done,
+# and they should still be played in order, each when the one before it is.
+
+import ecl
+import execute
+import feedback
+import io
+import sys
+import threading
+import time
+from typing import List, Tuple
+
+class FakeMixer:
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.played: List[Tuple[float, str]] = []
+
+class FakeSound:
+
+    def __init__(self, mixer: FakeMixer, name: str, length: float) -> None:
+        self.mixer = mixer
+        self.name = name
+        self.length = length
+
+    def get_length(self) -> float:
+        return self.length
+
+    def play(self) -> None:
+        with self.mixer.lock: self.mixer.played.append((time.monotonic(), self.name))
+
+class CountingOutput(io.StringIO):
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.writes: List[str] = []
+
+    def write(self, s: str) -> int:
+        self.writes.append(s)
+        return super().write(s)
+
+def confirm(words: List[str], longest: int) -> Tuple[float, bool]:
+    # as if the first longest words were good; returns how long it took, and
+    # whether the line was echoed in one write
+    pr = ecl.ParseResult[str]('')
+    pr.longest = longest
+    if longest != len(words): pr.missing = ['<command>']
+    out = CountingOutput()
+    stdout = sys.stdout
+    sys.stdout = out
+    start = time.monotonic()
+    try:
+        execute.confirm_input(words, pr, ' '.join(words), False, 'comp> ', None)
+    finally:
+        took = time.monotonic() - start
+        sys.stdout = stdout
+    return (took, any(w.startswith('comp> ' + words[0]) and words[-1] in w for w in out.writes))
+
+def main() -> None:
+    mixer = FakeMixer()
+    execute.good_beep = FakeSound(mixer, 'good', 0.1)
+    execute.all_good_beep = FakeSound(mixer, 'all-good', 0.1)
+    execute.bad_beep = FakeSound(mixer, 'bad', 0.1)
+    execute.color = False
+    execute.prompt = True
+
+    # five good words and a bad one, so five good beeps and then a bad one:
+    took, at_once = confirm('go left left left left nowhere'.split(), 5)
+    feedback.player.wait()
+    names = [name for _, name in mixer.played]
+    gaps = [b - a for (a, _), (b, _) in zip(mixer.played, mixer.played[1:])]
+    print('blocked for ' + ('under 50 ms' if took < 0.05 else '%.0f ms' % (took * 1000)) +
+        (', echoed at once' if at_once else ', echoed piecemeal') + ', then played: ' + ' '.join(names) +
+        (' (none early)' if all(gap >= 0.09 for gap in gaps) else ' (some early)'))
+
+    # the next line's beep replaces what's left of the previous line's ones:
+    mixer.played = []
+    confirm('go left left nowhere'.split(), 3)
+    time.sleep(0.15)
+    confirm('go left left left'.split(), 4)
+    feedback.player.wait()
+    print('then played: ' + ' '.join(name for _, name in mixer.played) + '; ' + feedback.player.statistics())
+
+if __name__ == '__main__': main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+# Checks that the tokenizer in util produces the same tokens and exceptions
+# as the straightforward (but quadratic) implementation it replaced,
+# on random strings made up of the characters it cares about.
+
+import random
+import util
+from typing import Any, Callable, List, Optional, Tuple
+
+def old_parse_quoted_string(s: str) -> Tuple[str, str]:
+    s = s[1:] # skip first "
+    x: List[str] = []
+    append = x.append
+    while not s.startswith('"'):
+        if s.startswith('\\"'): append('"'); s = s[2:]
+        elif s.startswith('\\\\'): append('\\'); s = s[2:]
+        elif s == '': raise Exception('missing "')
+        else: append(s[0]); s = s[1:]
+    s = s[1:] # skip final "
+    return (''.join(x), s)
+
+def old_parse_basic_expression(s: str) -> Tuple[str, str]:
+    curly_depth = 0
+    x: List[str] = []
+    append = x.append
+    while s != '':
+        if s[0] == ' ':
+            if curly_depth == 0: break
+            append(' ')
+            s = s[1:]
+        elif s[0] == '}':
+            if curly_depth == 0:
+                raise Exception("unmatched }")
+            curly_depth -= 1
+            append('}')
+            s = s[1:]
+        elif s[0] == '{':
+            curly_depth += 1
+            append('{')
+            s = s[1:]
+        elif s[0] == '"':
+            if curly_depth != 0: append('"')
+            y, s = old_parse_quoted_string(s)
+            append(y)
+            if curly_depth != 0: append('"')
+        else:
+            append(s[0])
+            s = s[1:]
+    return (''.join(x), s)
+
+def old_try_parse_braced_expr(s: str) -> Optional[Tuple[List[str], str]]:
+    if not s.startswith('{'):
+        return None
+    r: List[str] = []
+    s = s[1:].lstrip()
+    append = r.append
+    while not s.startswith('}'):
+        if not s: return None
+        y, s = old_parse_basic_expression(s)
+        if not y: return None
+        append(y)
+        s = s.lstrip()
+    return (r, s[1:])
+
+def old_split_expansion(s: str) -> List[str]:
+    s = s.lstrip()
+    r: List[str] = []
+    append = r.append
+    while s:
+        y, s = old_parse_basic_expression(s)
+        append(y)
+        s = s.lstrip()
+    return r
+
+def outcome(f: Callable[[str], Any], s: str) -> Any:
+    try: return f(s)
+    except Exception as e: return (type(e), str(e))
+
+pairs = [
+    (old_parse_quoted_string, util.parse_quoted_string),
+    (old_parse_basic_expression, util.parse_basic_expression),
+    (old_try_parse_braced_expr, util.try_parse_braced_expr),
+    (old_split_expansion, util.split_expansion)]
+
+def random_string(rnd: random.Random) -> str:
+    alphabet = ['a', 'b', 'xyz', ' ', ' ', '\t', '\n', '{', '{', '}', '}', '"', '"', '\\', '\\"', '\\\\']
+    s = ''.join(rnd.choice(alphabet) for _ in range(rnd.randint(0, 16)))
+    if rnd.random() < 0.5: s = rnd.choice(['"', '{', '{ ']) + s
+    return s
+
+def main() -> None:
+    rnd = random.Random(1)
+    n = 20000
+    bad = 0
+    for _ in range(n):
+        s = random_string(rnd)
+        for old, new in pairs:
+            if s[:1] != '"' and old is old_parse_quoted_string: continue # its precondition
+            if outcome(old, s) != outcome(new, s):
+                print(new.__name__ + ' disagrees on: ' + repr(s))
+                bad += 1
+    print(str(n) + ' strings, ' + str(bad) + ' disagreements')
+
+if __name__ == '__main__': main()
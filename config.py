@@ -0,0 +1,64 @@
+# The compiled forms of the config files, which are cached (pickled) next to
+# them. They're defined here rather than in execute.py, so that they pickle
+# under the same names whether execute.py runs as a script or is imported.
+
+import ecl
+from typing import Dict, FrozenSet, List, Optional, Set, Tuple
+
+class AutoEnableConfig: # for a given mode
+    always: bool
+    builtins: bool
+    other_modes: bool
+    for_prefixes: List[str]
+    for_suffixes: List[str]
+    for_applications: List[str]
+    for_leaf_applications: List[str]
+
+class AutoEnableIndex: # auto_enable_cfg, inverted
+    always: List[ecl.Mode]
+    by_application: Dict[str, List[ecl.Mode]]
+    by_leaf_application: Dict[str, List[ecl.Mode]]
+    by_prefix: Dict[int, Dict[str, List[ecl.Mode]]] # by length of the prefix
+    by_suffix: Dict[int, Dict[str, List[ecl.Mode]]]
+    order: Dict[ecl.Mode, int] # position in modes.yaml
+
+    def __init__(self, cfgs: Dict[ecl.Mode, AutoEnableConfig]):
+        self.always = [m for m, c in cfgs.items() if c.always]
+        self.by_application = {}
+        self.by_leaf_application = {}
+        self.by_prefix = {}
+        self.by_suffix = {}
+        self.order = {}
+        for m, c in cfgs.items():
+            self.order[m] = len(self.order)
+            for app in c.for_applications: self.by_application.setdefault(app, []).append(m)
+            for app in c.for_leaf_applications: self.by_leaf_application.setdefault(app, []).append(m)
+            for p in c.for_prefixes: self.by_prefix.setdefault(len(p), {}).setdefault(p, []).append(m)
+            for p in c.for_suffixes: self.by_suffix.setdefault(len(p), {}).setdefault(p, []).append(m)
+
+    def modes_for(self, title: str, apps: Tuple[FrozenSet[str], FrozenSet[str]]) -> Set[ecl.Mode]:
+        r = set(self.always)
+        names, leaves = apps
+        for app in names: r.update(self.by_application.get(app, []))
+        for app in leaves: r.update(self.by_leaf_application.get(app, []))
+        for n, d in self.by_prefix.items(): r.update(d.get(title[:n], []))
+        for n, d in self.by_suffix.items():
+            if n <= len(title): r.update(d.get(title[len(title)-n:], []))
+        return r
+
+class ReplacementNode: # replacements.yaml, as a trie of the misrecognitions to replace
+    children: Dict[str, 'ReplacementNode']
+    replacement: Optional[Tuple[int, List[str]]] # (priority, words)
+
+    def __init__(self) -> None:
+        self.children = {}
+        self.replacement = None
+
+class ModesConfig: # modes.yaml, fully processed
+    modes: Dict[ecl.Mode, ecl.Aliases]
+    enums: Dict[ecl.Typename, ecl.Pattern]
+    completions: Dict[ecl.Typename, str]
+    short_mode_names: Dict[ecl.Mode, str]
+    auto_enable_cfg: Dict[ecl.Mode, AutoEnableConfig]
+    auto_enable_index: AutoEnableIndex
+    always_on_modes: List[ecl.Mode]
@@ -1,6 +1,8 @@
 import util
 import termcolor
-from typing import Dict, List, Tuple, Optional, Callable, Any, TypeVar, Generic
+import threading
+from contextlib import contextmanager
+from typing import Dict, FrozenSet, List, Set, Tuple, Optional, Callable, Any, TypeVar, Generic, Iterator, Sequence
 
 Unit = str # either a literal or a type wrapped in <>
 Alternative = Tuple[Unit, bool]
@@ -8,6 +10,7 @@ Parameter = List[Alternative]
 Form = List[Parameter]
 Pattern = List[Form]
 Aliases = List[Tuple[Pattern, str]]
+Tokens = Tuple[str, ...] # input words, shared by all matching of a given input
 Mode = str
 Typename = str
 Action = Callable
@@ -51,6 +54,17 @@ class ParseResult(Generic[T]):
             self.retval = other.retval
             self.resolved = other.resolved
 
+    def copy(self) -> 'ParseResult[T]':
+        r = ParseResult[T](self.retval)
+        if type(self.retval) is list: r.retval = list(self.retval) # type: ignore
+        r.longest = self.longest
+        r.missing = list(self.missing)
+        r.actions = list(self.actions)
+        r.new_mode = self.new_mode
+        r.error = self.error
+        r.resolved = list(self.resolved)
+        return r
+
     def fmap(self, f: Callable[[T], U]) -> 'ParseResult[U]':
         r = ParseResult[U](f(self.retval))
         r.longest = self.longest
@@ -81,6 +95,97 @@ def parse_pattern(pattern: str) -> Pattern:
 def parse_aliases(aliases: Dict[str, str]) -> Aliases:
     return [(parse_pattern(pattern), defn) for pattern, defn in aliases.items()]
 
+# an alias expansion split up in advance into literal text (str), variables
+# (name and whether they're quoted) and $( ) subcommands (nested Templates)
+Template = List[Any]
+
+def compile_expansion(expansion: str, i: int = 0) -> Tuple[Template, int]:
+    # compiles expansion[i:] up to an unquoted ')', returning where it stopped
+    t: Template = []
+    text: List[str] = []
+    quoted = False
+    def flush() -> None:
+        if text: t.append(''.join(text)); text.clear()
+    while i < len(expansion):
+        c = expansion[i]
+        if not quoted and c == ')':
+            break
+        if c == '"':
+            quoted = not quoted
+            text.append(c)
+            i += 1
+        elif not quoted and expansion.startswith('$(', i):
+            flush()
+            sub, i = compile_expansion(expansion, i + 2)
+            t.append(sub)
+            i += 1 # skip )
+        elif c == '$':
+            j = i + 1
+            while j < len(expansion) and expansion[j].isalnum():
+                j += 1
+            flush()
+            t.append((expansion[i+1:j], quoted))
+            i = j
+        else:
+            text.append(c)
+            i += 1
+    flush()
+    return (t, i)
+
+First = Tuple[FrozenSet[str], bool]
+    # the literals something can start with, and whether it
+    # can also start with words that aren't known in advance
+
+def can_start(first: First, word: str) -> bool:
+    return first[1] or word in first[0]
+
+def union_first(firsts: List[First]) -> First:
+    return (frozenset().union(*[l for l, _ in firsts]), any([o for _, o in firsts]))
+
+def literal_first(form: Form) -> First:
+    # a conservative approximation that treats all types as open
+    return (frozenset([unit for unit, _ in form[0] if parse_type(unit) is None]),
+            any([parse_type(unit) is not None for unit, _ in form[0]]))
+
+def index_aliases(aliases: Aliases, first_of_form: Callable[[Form], First] = literal_first) -> Tuple[Dict[str, Aliases], Aliases]:
+    # maps each literal that an alias can start with to the aliases that
+    # might match input starting with that literal, which includes those
+    # that can start with any word. the latter are also returned separately,
+    # for input starting with a word that no alias starts with.
+    # in both cases, the aliases keep their original order.
+    starts: Dict[str, List[int]] = {}
+    open: List[int] = []
+    for i, (pattern, _) in enumerate(aliases):
+        literals, is_open = union_first(list(map(first_of_form, pattern)))
+        if is_open: open.append(i)
+        for l in literals: starts.setdefault(l, []).append(i)
+    index = dict([(l, [aliases[i] for i in sorted(set(ii + open))]) for l, ii in starts.items()])
+    return (index, [aliases[i] for i in open])
+
+class TrieNode:
+    # a node in the trie of the forms of all aliases,
+    # reached by matching the parameters on the path from the root
+    parent: Optional['TrieNode']
+    param: Parameter # on the edge from the parent
+    children: Dict[Tuple[Alternative, ...], 'TrieNode']
+
+    def __init__(self, parent: Optional['TrieNode'], param: Parameter):
+        self.parent = parent
+        self.param = param
+        self.children = {}
+
+    def descendant(self, form: Form) -> 'TrieNode':
+        n = self
+        for param in form:
+            key = tuple(param)
+            c = n.children.get(key)
+            if c is None:
+                c = n.children[key] = TrieNode(n, param)
+            n = c
+        return n
+
+TrieState = Tuple[ParseResult[List[str]], bool]
+
 class Context():
     modes: Dict[Mode, Aliases]
     color: bool
@@ -89,18 +194,30 @@ class Context():
     builtin_types: Dict[Typename, Callable[[Any], Any]]
     builtin_commands: List[BuiltinCommand]
     global_builtins: List[BuiltinCommand]
-
-    def __init__(self, modes: Dict[Mode, Dict[str, str]], enums: Dict[Typename, Pattern]):
+    pure_builtins: Set[Callable] # functional builtins whose results may be memoized
+    alias_index: Dict[Mode, Tuple[Dict[str, Aliases], Aliases]]
+    trie: bool
+    trie_root: TrieNode
+    trie_ends: Dict[int, List[TrieNode]]
+    evaluation: threading.local
+    memo_hits: int
+    memo_misses: int
+    type_first: Dict[Typename, First]
+    form_first: Dict[int, Tuple[Form, First]]
+    templates: Dict[str, Template]
+    completions: Dict[Typename, str] # shell commands listing a type's completions (see eclcompletion)
+
+    def __init__(self, modes: Dict[Mode, Aliases], enums: Dict[Typename, Pattern]):
         self.enums = enums
+        self.completions = {}
         self.script_vars = {}
         self.color = True
         self.builtin_commands = []
+        self.pure_builtins = set()
         self.builtin_types = {}
         self.always_on_modes = []
 
-        self.modes = {}
-        for mode, raw_aliases in modes.items():
-            self.modes[mode] = parse_aliases(raw_aliases)
+        self.modes = modes
 
         # validate patterns and expansions a bit:
         for m, aliases in self.modes.items():
@@ -120,6 +237,75 @@ class Context():
                 #            if not eclbuiltins.is_builtin_type(t) and not t in enums:
                 #                raise Exception(mode + ": " + pattern + ": no such type: " + t)
 
+        self.alias_index = {}
+        for m, aliases in self.modes.items():
+            self.alias_index[m] = index_aliases(aliases)
+
+        # for the trie engine (used by match_alias when self.trie is set),
+        # map each alias pattern (by id) to the trie nodes for its forms:
+        self.trie = False
+        self.trie_root = TrieNode(None, [])
+        self.trie_ends = {}
+        for aliases in self.modes.values():
+            for pattern, _ in aliases:
+                self.trie_ends[id(pattern)] = [self.trie_root.descendant(form) for form in pattern]
+
+        self.templates = {}
+        for aliases in self.modes.values():
+            for _, expansion in aliases:
+                if not expansion.startswith('~'):
+                    self.templates[expansion] = compile_expansion(expansion)[0]
+
+        # state of the evaluation of the outermost match_commands call (per thread):
+        # the memo table (see memoize) and the interned inputs (see match_commands)
+        self.evaluation = threading.local()
+        self.memo_hits = 0
+        self.memo_misses = 0
+
+        self.type_first = {}
+        self.form_first = {}
+
+    def compute_first_sets(self) -> None:
+        # precomputes the FIRST sets of all enum types and of all forms of
+        # all alias, enum and builtin patterns, so that matching can reject
+        # them based on the first word. must be called after builtin types
+        # and commands have been set.
+        self.type_first = dict([(t, (frozenset(), False)) for t in self.enums])
+        changed = True
+        while changed: # enums can refer to each other, so iterate to a fixpoint
+            changed = False
+            for t, pattern in self.enums.items():
+                f = union_first([self.first_of_form(form) for form in pattern])
+                if f != self.type_first[t]:
+                    self.type_first[t] = f
+                    changed = True
+
+        patterns = ([p for aliases in self.modes.values() for p, _ in aliases] + list(self.enums.values()) +
+                    [p for p, _, _ in self.builtin_commands + self.global_builtins])
+        self.form_first = {}
+        for pattern in patterns:
+            for form in pattern:
+                self.form_first[id(form)] = (form, self.first_of_form(form))
+
+        for m, aliases in self.modes.items():
+            self.alias_index[m] = index_aliases(aliases, self.first_of_form)
+
+    def first_of_unit(self, unit: Unit) -> First:
+        t = parse_type(unit)
+        if t is None: return (frozenset([unit]), False)
+        if t in self.builtin_types or (t not in self.enums and t != 'mode'):
+            return (frozenset(), True)
+        l = frozenset([unit]) # match_simple_parameter also matches the unit literally
+        is_open = False
+        if t == 'mode': l = frozenset(self.modes)
+        if t in self.enums:
+            tl, is_open = self.type_first.get(t, (frozenset(), True))
+            l = l | tl
+        return (l, is_open)
+
+    def first_of_form(self, form: Form) -> First:
+        return union_first([self.first_of_unit(unit) for unit, _ in form[0]])
+
     def colored(self, s: str, c: str) -> str:
         return termcolor.colored(s, c) if self.color else s
 
@@ -160,25 +346,55 @@ class Context():
         s = l[-1]; l[-1] = s[:-1] # remove last space
         return r + util.indented_and_wrapped(l, indent)
 
-    def match_type(self, args: List[str], type: Typename, enabled_modes: List[Mode]) -> ParseResult[List[str]]:
+    def memoize(self, key: Tuple, keep: Any, f: Callable[[], ParseResult]) -> ParseResult:
+        # during an evaluation, computes each f at most once per key, unless
+        # computing it called impure functional builtins (e.g. randomint),
+        # which must be called again each time.
+        # keep is stored along with the result so that ids in the key stay valid.
+        memo = getattr(self.evaluation, 'memo', None)
+        if memo is None: return f()
+        x = memo.get(key)
+        if x is not None:
+            self.memo_hits += 1
+            return x[1].copy()
+        self.memo_misses += 1
+        impure = self.evaluation.impure_calls
+        r = f()
+        if self.evaluation.impure_calls == impure: memo[key] = (keep, r.copy())
+        return r
+
+    def note_impure_call(self) -> None:
+        if getattr(self.evaluation, 'memo', None) is not None:
+            self.evaluation.impure_calls += 1
+
+    def match_type(self, words: Tokens, start: int, type: Typename, enabled_modes: List[Mode]) -> ParseResult[List[str]]:
+        return self.memoize(('type', type, id(words), start, tuple(enabled_modes)), words,
+            lambda: self.match_type_uncached(words, start, type, enabled_modes))
+
+    def match_type_uncached(self, words: Tokens, start: int, type: Typename, enabled_modes: List[Mode]) -> ParseResult[List[str]]:
+        word = words[start]
         bt = self.builtin_types.get(type)
-        if bt is not None and bt(args[0]):
-            pr = ParseResult[List[str]]([args[0]])
+        if bt is not None and bt(word):
+            pr = ParseResult[List[str]]([word])
             pr.longest = 1
             return pr
-        if type == 'mode' and args[0] in self.modes:
-            pr = ParseResult[List[str]]([args[0]])
+        if type == 'mode' and word in self.modes:
+            pr = ParseResult[List[str]]([word])
             pr.longest = 1
             return pr
         x = ParseResult[List[str]]([])
         x.missing = ['<' + type + '>']
         e = self.enums.get(type)
         if e is not None:
-            x.try_improve(self.match_pattern(e, args, enabled_modes))
+            first = self.type_first.get(type)
+            if first is None or can_start(first, word):
+                x.try_improve(self.match_pattern(e, words, start, enabled_modes))
+            else:
+                x.missing = [] # just like a failed match_pattern would have done
         return x
 
-    def match_simple_parameter(self, param: Parameter, args: List[str], enabled_modes: List[Mode]) -> ParseResult[Optional[str]]:
-        arg = args[0]
+    def match_simple_parameter(self, param: Parameter, words: Tokens, start: int, enabled_modes: List[Mode]) -> ParseResult[Optional[str]]:
+        arg = words[start]
         r = ParseResult[Optional[str]](None)
         for alt, multiple in param:
             if alt == arg:
@@ -188,13 +404,12 @@ class Context():
                 break
             type = parse_type(alt)
             if type is not None:
-                r.try_improve(self.match_type(args, type, enabled_modes).fmap(lambda x: ' '.join(x)))
+                r.try_improve(self.match_type(words, start, type, enabled_modes).fmap(lambda x: ' '.join(x)))
         return r
 
-    def match_parameter(self, param: Parameter, args: List[str], enabled_modes: List[Mode]) -> ParseResult[Optional[str]]:
+    def match_parameter(self, param: Parameter, words: Tokens, start: int, enabled_modes: List[Mode]) -> ParseResult[Optional[str]]:
         if param == [('<command>', False)]:
-            x = self.match_commands(args, enabled_modes, True, True)
-            consumed = list(map(util.quote_if_necessary, args[:x.longest]))
+            x = self.match_commands_at(words, start, enabled_modes, True, True)
             if x.longest == 0:
                 x.retval = None
             elif x.resolved is not None:
@@ -208,8 +423,9 @@ class Context():
             sub = [(param[0][0], False)]
             pr = ParseResult[Optional[str]](None)
             y = []
-            while args and args[0] != ';':
-                x = self.match_parameter(sub, args, enabled_modes)
+            i = start
+            while i < len(words) and words[i] != ';':
+                x = self.match_parameter(sub, words, i, enabled_modes)
                 pr.longest += x.longest
                 if x.longest != 0: pr.missing = x.missing
                 else: pr.missing += x.missing
@@ -217,80 +433,139 @@ class Context():
                 if x.retval is not None: y.append(x.retval)
                 if x.retval is None or x.longest == 0 or x.error is not None:
                     break
-                args = args[x.longest:]
+                i += x.longest
             pr.retval = ' '.join(map(util.quote_if_necessary, y))
             return pr
         else:
-            return self.match_simple_parameter(param, args, enabled_modes)
+            return self.match_simple_parameter(param, words, start, enabled_modes)
 
-    def match_params(self, params: List[Parameter], args: List[str], enabled_modes: List[Mode]) -> ParseResult[List[str]]:
+    def match_params(self, params: List[Parameter], words: Tokens, start: int, enabled_modes: List[Mode]) -> ParseResult[List[str]]:
         pr = ParseResult[List[str]]([])
-        while params and args:
-            x = self.match_parameter(params[0], args, enabled_modes)
+        i = start
+        j = 0
+        while j < len(params) and i < len(words):
+            x = self.match_parameter(params[j], words, i, enabled_modes)
             pr.longest += x.longest
             if x.longest != 0: pr.missing = x.missing
             if x.error is not None: pr.error = x.error
             if x.retval is None or x.longest == 0: break
-            args = args[x.longest:]
-            params = params[1:]
+            i += x.longest
+            j += 1
             pr.retval.append(x.retval)
-        if params and not pr.missing:
-            pr.missing = [unit for unit, _ in params[0]]
+        if j < len(params) and not pr.missing:
+            pr.missing = [unit for unit, _ in params[j]]
         return pr
 
-    def match_pattern(self, pattern: Pattern, input: List[str], enabled_modes: List[Mode]) -> ParseResult[List[str]]:
+    def match_pattern(self, pattern: Pattern, words: Tokens, start: int, enabled_modes: List[Mode]) -> ParseResult[List[str]]:
+        return self.memoize(('pattern', id(pattern), id(words), start, tuple(enabled_modes)), (pattern, words),
+            lambda: self.match_pattern_uncached(pattern, words, start, enabled_modes))
+
+    def match_pattern_uncached(self, pattern: Pattern, words: Tokens, start: int, enabled_modes: List[Mode]) -> ParseResult[List[str]]:
         pr = ParseResult[List[str]]([])
         for form in pattern:
-            pr.try_improve(self.match_params(form, input, enabled_modes))
+            f = self.form_first.get(id(form))
+            if f is not None and start < len(words) and not can_start(f[1], words[start]):
+                continue # would match nothing, which would not affect pr
+            pr.try_improve(self.match_params(form, words, start, enabled_modes))
+        return pr
+
+    def match_trie_node(self, node: TrieNode, words: Tokens, start: int, enabled_modes: List[Mode],
+            memo: Dict[int, TrieState]) -> TrieState:
+        # the state match_params is in after matching the parameters on the path to node,
+        # and whether it stopped there or before (in which case the state is final).
+        # this is shared by all forms whose parameters start with that path.
+        # (ParseResults are made without the type argument here, since
+        # subscripting the generic class on every call is a large part of the cost)
+        s = memo.get(id(node))
+        if s is not None: return s
+        impure = getattr(self.evaluation, 'impure_calls', 0) # as in memoize
+        if node.parent is None:
+            empty: ParseResult[List[str]] = ParseResult([])
+            s = (empty, False)
+        else:
+            pr, stopped = self.match_trie_node(node.parent, words, start, enabled_modes, memo)
+            if not stopped:
+                q: ParseResult[List[str]] = ParseResult(pr.retval)
+                q.longest = pr.longest
+                q.missing = pr.missing
+                q.error = pr.error
+                i = start + pr.longest
+                stopped = True
+                if i < len(words):
+                    x = self.match_parameter(node.param, words, i, enabled_modes)
+                    q.longest += x.longest
+                    if x.longest != 0: q.missing = x.missing
+                    if x.error is not None: q.error = x.error
+                    if x.retval is not None and x.longest != 0:
+                        q.retval = pr.retval + [x.retval]
+                        stopped = False
+                if stopped and not q.missing:
+                    q.missing = [unit for unit, _ in node.param]
+                pr = q
+            s = (pr, stopped)
+        if getattr(self.evaluation, 'impure_calls', 0) == impure: memo[id(node)] = s
+        return s
+
+    def trie_memo(self, words: Tokens, start: int, enabled_modes: List[Mode]) -> Dict[int, TrieState]:
+        # the states of the trie nodes when matching at start, shared by all
+        # match_alias calls of an evaluation that match there (see memoize)
+        memo = getattr(self.evaluation, 'memo', None)
+        if memo is None: return {}
+        key = ('trie', id(words), start, tuple(enabled_modes))
+        x = memo.get(key)
+        if x is None: x = memo[key] = (words, {})
+        return x[1]
+
+    def match_pattern_in_trie(self, pattern: Pattern, words: Tokens, start: int, enabled_modes: List[Mode],
+            memo: Dict[int, TrieState]) -> ParseResult[List[str]]:
+        # equivalent to match_pattern, but shares work with other aliases through
+        # memo (which, being per evaluation, also makes memoizing this redundant)
+        ends = self.trie_ends.get(id(pattern))
+        if ends is None: return self.match_pattern(pattern, words, start, enabled_modes)
+        pr: ParseResult[List[str]] = ParseResult([])
+        for form, node in zip(pattern, ends):
+            f = self.form_first.get(id(form))
+            if f is not None and start < len(words) and not can_start(f[1], words[start]):
+                continue # as in match_pattern_uncached
+            x, _ = self.match_trie_node(node, words, start, enabled_modes, memo)
+            y: ParseResult[List[str]] = ParseResult(list(x.retval))
+            y.longest = x.longest
+            y.missing = list(x.missing)
+            y.error = x.error
+            pr.try_improve(y)
         return pr
 
     def get_var(self, v: str, vars: List[str]) -> Optional[str]:
         if v.isdigit(): return vars[int(v)]
         return self.script_vars.get(v)
 
-    def substitute_variables(self, expansion: str, vars: List[str], enabled_modes: List[Mode]) -> Tuple[List[str], str, Optional[str]]:
-        err = None
+    def substitute_variables(self, expansion: str, vars: List[str], enabled_modes: List[Mode]) -> Tuple[List[str], Optional[str]]:
+        t = self.templates.get(expansion)
+        if t is None:
+            t = self.templates[expansion] = compile_expansion(expansion)[0]
+        return self.instantiate(t, vars, enabled_modes)
+
+    def instantiate(self, template: Template, vars: List[str], enabled_modes: List[Mode]) -> Tuple[List[str], Optional[str]]:
         parts: List[str] = []
-        append = parts.append
-        quoted = False
-        while expansion != '':
-            if not quoted and expansion.startswith(')'):
-                break
-            if expansion[0] == '"':
-                quoted = not quoted
-                append('"')
-                expansion = expansion[1:]
-            elif not quoted and expansion.startswith('$('):
-                sub = expansion[2:]
-                args, rest, _err = self.substitute_variables(sub, vars, enabled_modes)
+        for x in template:
+            if type(x) is str:
+                parts.append(x)
+            elif type(x) is tuple:
+                varname, quoted = x
+                v = self.get_var(varname, vars)
+                if v is None: return ([], 'undefined variable $' + varname)
+                parts.append(util.escape(v) if quoted else v)
+            else:
+                args, err = self.instantiate(x, vars, enabled_modes)
+                if err is not None: return ([], err)
                 pr = self.match_commands(args, enabled_modes, True, False)
-                consumed = args[:pr.longest]
-                unconsumed = args[pr.longest:]
-                if pr.error is not None:
-                    err = pr.error
-                    break
+                if pr.error is not None: return ([], pr.error)
                 if pr.missing or pr.longest != len(args):
-                    err = self.describe_cmd_parse_result(pr, args)
-                    break
-                append(str(pr.retval))
-                expansion = rest[1:]
-            elif expansion.startswith('$'):
-                i = 1
-                while i < len(expansion) and expansion[i].isalnum():
-                    i += 1
-                varname = expansion[1:i]
-                expansion = expansion[i:]
-                x = self.get_var(varname, vars)
-                if x is None:
-                    err = 'undefined variable $' + varname
-                    break
-                append(util.escape(x) if quoted else x)
-            else:
-                append(expansion[0])
-                expansion = expansion[1:]
-        return (util.split_expansion(''.join(parts)), expansion, err)
+                    return ([], self.describe_cmd_parse_result(pr, args))
+                parts.append(str(pr.retval))
+        return (util.split_expansion(''.join(parts)), None)
 
-    def describe_cmd_parse_result(self, pr: ParseResult, exp) -> str:
+    def describe_cmd_parse_result(self, pr: ParseResult, exp: Sequence[str]) -> str:
         qexp = list(map(util.quote_if_necessary, exp))
         x = [self.colored(s, 'green') + ' ' for s in qexp[:pr.longest]] + \
             [self.colored(s, 'red') + ' ' for s in qexp[pr.longest:]]
@@ -300,23 +575,26 @@ class Context():
                ('missing ' if pr.longest == len(exp) else 'expected ') +
                ' or '.join(map(self.render_unit, pr.missing)) + '\n')
 
-    def match_alias(self, input: List[str],
+    def match_alias(self, words: Tokens, start: int,
             enabled_modes: List[Mode],
             input_modes: List[Mode]) -> ParseResult:
         r = ParseResult[Tuple[List[str], Mode, str, Pattern]](([], '', '', []))
+        memo = (self.trie_memo(words, start, input_modes) if self.trie else {})
         for m in (["default"] if enabled_modes[:1] == ["default"] else enabled_modes):
-            for pattern, e in self.modes[m]:
-                r.try_improve(self.match_pattern(
-                    pattern, input, input_modes).fmap(lambda z: (z, m, e, pattern)))
+            index, typed = self.alias_index[m]
+            for pattern, e in (index.get(words[start], typed) if start < len(words) else []):
+                x = (self.match_pattern_in_trie(pattern, words, start, input_modes, memo) if self.trie
+                     else self.match_pattern(pattern, words, start, input_modes))
+                r.try_improve(x.fmap(lambda z: (z, m, e, pattern)))
 
         if r.longest == 0 or r.missing: return r
         vars, m, expansion, pattern = r.retval
 
         if expansion == '~builtin':
-            return self.match_builtin(input, enabled_modes, False)
+            return self.match_builtin(words, start, enabled_modes, False)
         if expansion.startswith('~'):
             mod = expansion[1:]
-            return self.match_alias(input, [mod], input_modes)
+            return self.match_alias(words, start, [mod], input_modes)
 
         r.resolved = vars
         pre = ['{', 'builtin', 'mode', m]
@@ -324,10 +602,10 @@ class Context():
             r.resolved = pre + vars + ['}']
 
         errorpart: Callable[[], str] = lambda: \
-            'command ' + self.colored(' '.join(map(util.quote_if_necessary, input[:r.longest])), 'green') + \
+            'command ' + self.colored(' '.join(map(util.quote_if_necessary, words[start:start + r.longest])), 'green') + \
             ' matched alias:\n  ' + self.alias_definition_str(m, pattern, expansion, 3) + '\n'
 
-        exp, _rest, err = self.substitute_variables(expansion, vars[:r.longest], enabled_modes)
+        exp, err = self.substitute_variables(expansion, vars[:r.longest], enabled_modes)
         if err is not None: r.error = errorpart() + err; return r
 
         sub = self.match_commands(exp, [m], True, False)
@@ -341,16 +619,16 @@ class Context():
             r.retval = sub.retval
         return r
 
-    def match_builtin(self, input: List[str], enabled_modes: List[Mode], only_global: bool) -> ParseResult[Any]:
+    def match_builtin(self, words: Tokens, start: int, enabled_modes: List[Mode], only_global: bool) -> ParseResult[Any]:
         def nullaction(): pass
         r = ParseResult[Tuple[List[str], Callable, Action, Pattern]](([], nullaction, nullaction, []))
         for pattern, f, act in self.global_builtins:
             r.try_improve(self.match_pattern(
-                pattern, input, enabled_modes).fmap(lambda z: (z, f, act, pattern)))
+                pattern, words, start, enabled_modes).fmap(lambda z: (z, f, act, pattern)))
         if not only_global:
             for pattern, f, act in self.builtin_commands:
                 r.try_improve(self.match_pattern(
-                    pattern, input, enabled_modes).fmap(lambda z: (z, f, act, pattern)))
+                    pattern, words, start, enabled_modes).fmap(lambda z: (z, f, act, pattern)))
         vars, f, act, pattern = r.retval
 
         r2: ParseResult[Any] = r.fmap(lambda _: None)
@@ -360,6 +638,7 @@ class Context():
                 r2.resolved = []
         if r2.longest != 0 and not r2.missing:
             if f is not None:
+                if f not in self.pure_builtins: self.note_impure_call()
                 ctx = {'enabled_modes': enabled_modes, 'ecl': self}
                 r2.retval = f(ctx, *vars)
             if act is not None: r2.actions = [(act, vars)]
@@ -368,29 +647,99 @@ class Context():
                 # which is beyond the capabilities of regular built-ins,
                 # since those only produce actions to be executed later.
                 # hence this special case for the 'mode' command.
-        elif input:
-            cmd, *args = input
-            if cmd == 'builtin':
-                r2 = self.match_builtin(args, enabled_modes, False)
+        elif start < len(words):
+            if words[start] == 'builtin':
+                r2 = self.match_builtin(words, start + 1, enabled_modes, False)
                 r2.longest += 1 # to account for 'builtin' itself
         return r2
 
-    def match_command(self, words: List[str], enabled_modes: List[Mode], handle_builtins: bool = True) -> ParseResult[Any]:
+    def add_always_on_modes(self, enabled_modes: List[Mode]) -> None:
         if enabled_modes[:1] != ['default']:
             for m in self.always_on_modes:
                 if m not in enabled_modes: enabled_modes.append(m)
 
-        pr = self.match_alias(words, enabled_modes, enabled_modes)
+    def match_command(self, words: Tokens, start: int, enabled_modes: List[Mode], handle_builtins: bool = True) -> ParseResult[Any]:
+        self.add_always_on_modes(enabled_modes)
+
+        pr = self.match_alias(words, start, enabled_modes, enabled_modes)
         if handle_builtins:
-            pr.try_improve(self.match_builtin(words, enabled_modes, True))
+            pr.try_improve(self.match_builtin(words, start, enabled_modes, True))
         return pr
 
-    def match_commands(self, words: List[str], enabled_modes: List[Mode],
+    @contextmanager
+    def shared_evaluation(self) -> Iterator[None]:
+        # makes the match_commands calls inside it one evaluation, sharing a
+        # memo (e.g. when trying many inputs that repeat each other)
+        outermost = getattr(self.evaluation, 'memo', None) is None
+        if outermost:
+            self.evaluation.memo = {}
+            self.evaluation.interned = {}
+            self.evaluation.impure_calls = 0
+        try:
+            yield
+        finally:
+            if outermost:
+                self.evaluation.memo = None
+                self.evaluation.interned = None
+
+    def match_commands(self, words: Sequence[str], enabled_modes: List[Mode],
             handle_builtins: bool = True,
             stop_on_semicolon: bool = False) -> ParseResult:
-        assert words and words[0] != '}'
+        with self.shared_evaluation():
+            # equal inputs share a tuple, so that memo keys can refer to it by id
+            # (repeated substitutions are then matched once, which is only
+            # right because memoize skips results that called impure builtins):
+            t = tuple(words)
+            t = self.evaluation.interned.setdefault(t, t)
+            return self.match_commands_at(t, 0, enabled_modes, handle_builtins, stop_on_semicolon)
+
+    def match_commands_at(self, words: Tokens, start: int, enabled_modes: List[Mode],
+            handle_builtins: bool, stop_on_semicolon: bool) -> ParseResult:
+        # matches the commands in words[start:], without copying them.
+        # the longest of the result counts words from start.
+        assert start < len(words) and words[start] != '}'
+
+        # done here rather than in match_command so that it also happens on memo hits:
+        self.add_always_on_modes(enabled_modes)
+
+        return self.memoize(('commands', id(words), start, tuple(enabled_modes), handle_builtins, stop_on_semicolon), words,
+            lambda: self.match_commands_uncached(words, start, enabled_modes, handle_builtins, stop_on_semicolon))
+
+    def match_commands_uncached(self, words: Tokens, start: int, enabled_modes: List[Mode],
+            handle_builtins: bool, stop_on_semicolon: bool) -> ParseResult:
+        # chained commands are matched in a loop rather than by recursion,
+        # so that long chains don't run into the recursion limit.
+        r = self.match_single_command(words, start, enabled_modes, handle_builtins)
+        last = r
+        i = start + r.longest
+        while last.longest != 0 and i != len(words) and last.error is None and not last.missing:
+            if words[i] == ';':
+                if stop_on_semicolon: break
+                i += 1
+                r.resolved.append(';')
+                r.longest += 1
+                if i == len(words): break
+            if last.new_mode is not None:
+                enabled_modes = [last.new_mode] + [m for m in enabled_modes if m != last.new_mode]
+                self.add_always_on_modes(enabled_modes)
+            assert words[i] != '}'
+            last = self.match_single_command(words, i, enabled_modes, True)
+            i += last.longest
+            r.longest += last.longest
+            r.resolved += last.resolved
+            r.missing = last.missing
+            r.actions += last.actions
+            if last.error is not None: r.error = last.error
+            if last.longest != 0:
+                if last.new_mode is not None:
+                    r.new_mode = last.new_mode
+                r.retval = last.retval
+        return r
 
-        x = util.try_parse_braced_expr(words[0])
+    def match_single_command(self, words: Tokens, start: int, enabled_modes: List[Mode],
+            handle_builtins: bool) -> ParseResult:
+        # matches a single (possibly braced) command, ignoring whatever follows it
+        x = util.try_parse_braced_expr(words[start])
         if x is not None and x[1] == '':
             sub = x[0]
             r = self.match_commands(sub, enabled_modes, handle_builtins, False)
@@ -401,30 +750,9 @@ class Context():
                     r.error = self.describe_cmd_parse_result(r, sub)
                 r.longest = 0
         else:
-            r = self.match_command(words, enabled_modes, handle_builtins)
+            r = self.match_command(words, start, enabled_modes, handle_builtins)
 
         if r.longest == 0:
             r.missing = ['<command>']
             r.actions = []
-        else:
-            if r.longest != len(words) and r.error is None and not r.missing:
-                w = words[r.longest:]
-                if w and w[0] == ';':
-                    if stop_on_semicolon: return r
-                    w = w[1:]
-                    r.resolved.append(';')
-                    r.longest += 1
-                if w:
-                    if r.new_mode is not None:
-                        enabled_modes = [r.new_mode] + [m for m in enabled_modes if m != r.new_mode]
-                    r2 = self.match_commands(w, enabled_modes, True, stop_on_semicolon)
-                    r.longest += r2.longest
-                    r.resolved += r2.resolved
-                    r.missing = (r.missing if r2.longest == 0 else []) + r2.missing
-                    r.actions += r2.actions
-                    if r2.error is not None: r.error = r2.error
-                    if r2.longest != 0:
-                        if r2.new_mode is not None:
-                            r.new_mode = r2.new_mode
-                        r.retval = r2.retval
         return r
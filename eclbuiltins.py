@@ -1,42 +1,52 @@
+import actions
+import keys
 import termcolor
-import subprocess
+import subprocesses
 import time
 import ecl
 import util
-import threading
 import os
 import sys
 import util
 import random
 import pyautogui # type: ignore
-from typing import Dict, List, Tuple, Callable, Optional
+from typing import Any, Dict, List, Set, Tuple, Callable, Optional
 
 builtin_commands: List[ecl.BuiltinCommand] = []
 global_builtins: List[ecl.BuiltinCommand] = []
+pure_builtins: Set[Callable] = set() # functional ones (see make_functional_builtin)
+stateful_builtins: Set[Callable] = set() # see make_builtin
 
 dryrun = False
 
-def make_builtin(pattern: str) -> Callable[[Callable], Callable]:
-    def f(g):
+def make_builtin(pattern: str, stateful: bool = False) -> Callable[[Callable], Callable]:
+    # stateful ones change what later lines match (e.g. variables for
+    # functional builtins), so those aren't matched until they've run
+    def f(g: Callable) -> Callable:
         builtin_commands.append((ecl.parse_pattern(pattern), None, g))
+        if stateful: stateful_builtins.add(g)
         return g
     return f
 
 def make_global_builtin(pattern: str) -> Callable[[Callable], Callable]:
-    def f(g):
+    def f(g: Callable) -> Callable:
         global_builtins.append((ecl.parse_pattern(pattern), None, g))
         return g
     return f
 
-def make_functional_builtin(pattern: str) -> Callable[[Callable], Callable]:
-    def f(g):
+def make_functional_builtin(pattern: str, pure: bool = False) -> Callable[[Callable], Callable]:
+    # pure ones return the same for the same arguments (during an evaluation),
+    # so that their results can be memoized (see ecl.Context.memoize)
+    def f(g: Callable) -> Callable:
         builtin_commands.append((ecl.parse_pattern(pattern), g, None))
+        if pure: pure_builtins.add(g)
         return g
     return f
 
-def make_global_functional_builtin(pattern: str) -> Callable[[Callable], Callable]:
-    def f(g):
+def make_global_functional_builtin(pattern: str, pure: bool = False) -> Callable[[Callable], Callable]:
+    def f(g: Callable) -> Callable:
         global_builtins.append((ecl.parse_pattern(pattern), g, None))
+        if pure: pure_builtins.add(g)
         return g
     return f
 
@@ -67,11 +77,13 @@ extra_key_names: Dict[str, str] = {
     'double quote': '"',
 }
 
+scheduler = actions.Scheduler(workers=8) # for 'asynchronously'
+
 builtin_types = {
     'word': lambda _: True,
     'number': lambda s: s.isdigit(),
     'positive': lambda s: s.isdigit() and int(s) > 0,
-    'job': lambda n: n.isdigit() and int(n) in jobs,
+    'job': lambda n: n.isdigit() and scheduler.is_active(int(n)),
     'key': is_keyname,
 }
 
@@ -80,7 +92,7 @@ def is_builtin_type(t: ecl.Typename) -> bool:
 
 #######################################
 
-@make_builtin('set <word> <word>')
+@make_builtin('set <word> <word>', stateful=True)
 def cmd_set(ctx, _set, var, val):
     e = ctx['ecl']
     e.script_vars[var] = val
@@ -90,74 +102,83 @@ def cmd_get(ctx, _get, var):
     e = ctx['ecl']
     return e.script_vars[var] if var in e.script_vars else 'undefined'
 
-@make_functional_builtin('head <word>')
+@make_functional_builtin('parser statistics')
+def cmd_parser_statistics(ctx: Dict[str, Any], _parser: str, _statistics: str) -> str:
+    e = ctx['ecl']
+    return 'memo hits: ' + str(e.memo_hits) + ', misses: ' + str(e.memo_misses)
+
+@make_functional_builtin('first set of <word>', pure=True)
+def cmd_first_set(ctx: Dict[str, Any], _first: str, _set: str, _of: str, t: str) -> str:
+    e = ctx['ecl']
+    if t not in e.type_first: return 'no such type: ' + t
+    literals, is_open = e.type_first[t]
+    return ' / '.join(sorted(literals) + (['...'] if is_open else []))
+
+@make_functional_builtin('head <word>', pure=True)
 def cmd_head(_, _head, w):
     return w[:1]
 
-jobs: Dict[int, str] = {}
-next_job_nr = 0
-
 @make_builtin('jobs')
-def cmd_jobs(_):
-    if jobs == {}:
-        print('No active jobs.')
-        return
-    for n, cmd in jobs.items():
-        print(str(n) + ':', cmd)
+def cmd_jobs(_ctx: Dict[str, Any], _jobs: str) -> None:
+    util.print_line('\n'.join(scheduler.describe()))
 
 @make_builtin('cancel job <job>')
-def cmd_cancel_job(_cancel, _job, n):
-    n = int(n)
-    if n in jobs: del jobs[n]
+def cmd_cancel_job(_ctx: Dict[str, Any], _cancel: str, _job: str, n: str) -> None:
+    scheduler.cancel(int(n))
 
-@make_builtin('window processes')
-def cmd_window_processes(*_):
-    _, processes = util.get_current_application()
-    print('  ' + util.print_pstree(processes, 2))
+def canceled(ctx: Dict[str, Any]) -> bool:
+    # whether the job or line that the running action is part of was canceled
+    return 'canceled' in ctx and ctx['canceled']()
 
 @make_builtin('asynchronously <command>')
 def cmd_asynchronously(ctx, _, cmd):
-    global jobs, next_job_nr
     pr = ctx['ecl'].match_commands(util.split_expansion(cmd), [])
-    n = next_job_nr
-    next_job_nr += 1
-    jobs[n] = cmd
-    def f():
-        # todo: VERY EVIL unsafe concurrent access to 'jobs' below
-        status = 'finished'
-        for act, w in pr.actions:
-            if n not in jobs:
-                status = 'canceled'
-                break
-            act(ctx, *w)
-        if n in jobs: del jobs[n]
-        print(' ', status + ':', ctx['ecl'].colored(cmd, 'green'))
+    def f(job: actions.Job) -> None:
+        try:
+            run_actions(dict(ctx, canceled=job.canceled), pr.actions)
+        except Exception as e:
+            util.print_line('  failed: ' + ctx['ecl'].colored(cmd, 'green') + ': ' + str(e))
+            raise
+        util.print_line('  ' + ('canceled' if job.canceled() else 'finished') + ': ' + ctx['ecl'].colored(cmd, 'green'))
         #if prompt: print_prompt()
-    threading.Thread(target=f).start()
+    scheduler.submit(cmd, f)
 
 @make_builtin('run <word>+')
 def cmd_run(_ctx, _, cmd):
     if dryrun:
         print("running", cmd)
         return
-    subprocess.Popen(
-        util.split_expansion(cmd), shell=False, close_fds=True,
-        stdin=subprocess.DEVNULL,
-        stdout=subprocess.DEVNULL,
-        stderr=subprocess.DEVNULL)
+    subprocesses.runner.spawn(util.split_expansion(cmd))
+
+execute_timeout = 60.0 # seconds
 
 @make_builtin('execute <word>+')
 def cmd_execute(ctx, _, cmd):
     if dryrun:
         print("executing", cmd)
         return
-    output = subprocess.Popen(
-        util.split_expansion(cmd), shell=False,
-        stdin=subprocess.PIPE,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE).stdout.read().decode('utf-8').strip()
-    if output != '':
-        print(ctx['ecl'].colored(output, 'magenta'))
+    blank = 0
+    started = False
+    def show(lines: List[str]) -> None:
+        # as they arrive, but without leading and trailing blank lines
+        nonlocal blank, started
+        shown = []
+        for line in lines:
+            if line.strip() == '':
+                blank += 1
+                continue
+            if started: shown += [''] * blank
+            blank = 0
+            started = True
+            shown.append(ctx['ecl'].colored(line, 'magenta'))
+        if shown: util.print_line('\n'.join(shown))
+    r = subprocesses.runner.run(util.split_expansion(cmd), timeout=execute_timeout,
+        on_lines=show, canceled=lambda: canceled(ctx))
+    if r.timed_out: raise Exception('timed out after %g s' % execute_timeout)
+
+@make_builtin('subprocess statistics')
+def cmd_subprocess_statistics(*_: Any) -> None:
+    util.print_line(subprocesses.runner.statistics())
 
 startup_cwd = os.getcwd()
 
@@ -166,46 +187,72 @@ def cmd_restart(_ctx, _restart, _commander):
     os.chdir(startup_cwd)
     os.execl(sys.argv[0], *sys.argv)
 
+key_backend: Any = None # see keys.make_backend
+key_stats = (0, 0, 0.0) # events, batches, seconds
+
+def send_keys(events: List[keys.Event]) -> None:
+    global key_backend, key_stats
+    if key_backend is None: key_backend = keys.make_backend('auto', 0.012)
+    start = time.perf_counter()
+    key_backend.keys(events)
+    n, batches, total = key_stats
+    key_stats = (n + len(events), batches + 1, total + time.perf_counter() - start)
+
+def send_text(ctx: Dict[str, Any], s: str) -> None:
+    global key_backend, key_stats
+    if key_backend is None: key_backend = keys.make_backend('auto', 0.012)
+    for i in range(0, len(s), 32): # so that it can be canceled halfway
+        if canceled(ctx): break
+        start = time.perf_counter()
+        key_backend.type(s[i:i + 32])
+        n, batches, total = key_stats
+        key_stats = (n + 2 * len(s[i:i + 32]), batches + 1, total + time.perf_counter() - start)
+
+@make_builtin('key statistics')
+def cmd_key_statistics(*_: Any) -> None:
+    n, batches, total = key_stats
+    util.print_line(str(n) + ' events in ' + str(batches) + ' batches, %.0f events/s' % (n / max(total, 1e-9)))
+
 @make_builtin('keydown <key>')
 def cmd_keydown(_ctx, _keydown, key_name):
-    if not dryrun: # pragma: no cover
-        pyautogui.keyDown(key_by_name(key_name))
+    if not dryrun:
+        send_keys([(key_by_name(key_name), True)])
 
 @make_builtin('keyup <key>')
 def cmd_keyup(_ctx, _keyup, key_name):
-    if not dryrun: # pragma: no cover
-        pyautogui.keyUp(key_by_name(key_name))
+    if not dryrun:
+        send_keys([(key_by_name(key_name), False)])
 
 @make_builtin('shutdown commander')
 def cmd_exit(_ctx, _shutdown, _commander):
     sys.stdout.write("\033[?25h") # restore cursor
     sys.exit(0)
 
-@make_functional_builtin('<number> plus <number>')
+@make_functional_builtin('<number> plus <number>', pure=True)
 def cmd_plus(_ctx, x, _p, y):
     return int(x) + int(y)
 
-@make_functional_builtin('<number> minus <number>')
+@make_functional_builtin('<number> minus <number>', pure=True)
 def cmd_minus(_ctx, x, _p, y):
     return int(x) - int(y)
 
-@make_functional_builtin('<number> times <number>')
+@make_functional_builtin('<number> times <number>', pure=True)
 def num_times_num(_ctx, x, _p, y):
     return int(x) * int(y)
 
-@make_functional_builtin('<number> is less than <number>')
+@make_functional_builtin('<number> is less than <number>', pure=True)
 def cmd_less_than(_ctx, x, _is, _less, _than, y):
     return "true" if int(x) < int(y) else "false"
 
-@make_functional_builtin('<number> is greater than <number>')
+@make_functional_builtin('<number> is greater than <number>', pure=True)
 def cmd_greater_than(_ctx, x, _is, _greater_, _than, y):
     return "true" if int(x) > int(y) else "false"
 
-@make_functional_builtin('<word> equals <word>')
+@make_functional_builtin('<word> equals <word>', pure=True)
 def cmd_equals(_ctx, x, _equals, y):
     return "true" if x == y else "false"
 
-@make_functional_builtin('enumindex <word> <word>')
+@make_functional_builtin('enumindex <word> <word>', pure=True)
 def cmd_enumindex(ctx, _, e: ecl.Typename, v: str):
     pattern: ecl.Pattern = ctx['ecl'].enums[e]
     form: ecl.Form = [[(v, False)]]
@@ -247,13 +294,13 @@ def cmd_define(ctx, _, braced_cmd):
     mode, cmd = strip_mode(cmd)
     if mode == 'builtin':
         for pattern, f, g in builtin_commands:
-            pr = ecl.match_pattern(pattern, cmd, [])
+            pr = ecl.match_pattern(pattern, tuple(cmd), 0, [])
             if pr.longest > 0 and not pr.missing and pr.error is None:
                 if f is None: f = g
                 if f is not None: print_builtin(ecl, pattern, f)
     else:
         for pattern, exp in ecl.modes[mode]:
-            pr = ecl.match_pattern(pattern, cmd, [mode])
+            pr = ecl.match_pattern(pattern, tuple(cmd), 0, [mode])
             if pr.longest > 0 and not pr.missing and pr.error is None:
                 print('\nin ', end='')
                 print(ecl.alias_definition_str(mode, pattern, exp, len('in ')))
@@ -280,46 +327,43 @@ def cmd_options(ctx, _):
     return output
 
 @make_builtin('text <word>+')
-def cmd_text(_ctx, _, s):
+def cmd_text(ctx: Dict[str, Any], _: str, s: str) -> None:
     if dryrun:
         print("entering text", s)
     else:
-        pyautogui.press([c for c in s]) # pragma: no cover
+        send_text(ctx, s)
 
 builtin_commands.append((ecl.parse_pattern('mode <mode>'), None, None))
 
-@make_functional_builtin('return <word>')
+@make_functional_builtin('return <word>', pure=True)
 def cmd_return(_ctx, _, w):
     return w
 
 @make_builtin('press <key>+')
 def cmd_press(_ctx, _, spec):
     if dryrun: print("pressing", spec)
+    events: List[keys.Event] = []
     modifiers = []
     for key in util.split_expansion(spec):
         if key in modifier_keys:
             modifiers.append(key)
         else:
-            if not modifiers:
-                key = key_by_name(key)
-                if not dryrun: pyautogui.press([key]) # pragma: no cover
-            else:
-                keys = list(map(key_by_name, modifiers + [key]))
-                if not dryrun: # pragma: no cover
-                    for k in keys: pyautogui.keyDown(k, pause=0.02)
-                    for k in reversed(keys): pyautogui.keyUp(k, pause=0.02)
-                modifiers = []
+            chord = list(map(key_by_name, modifiers + [key]))
+            events += [(k, True) for k in chord] + [(k, False) for k in reversed(chord)]
+            modifiers = []
+    if not dryrun: send_keys(events)
 
 @make_builtin('print <word>+')
 def cmd_print(ctx, _, s):
-    print(ctx['ecl'].colored(' '.join(util.split_expansion(s)), 'magenta'))
+    util.print_line(ctx['ecl'].colored(' '.join(util.split_expansion(s)), 'magenta'))
 
 @make_functional_builtin('randomint <number>')
 def cmd_randomint(_ctx, _randomint, max):
     return str(random.randint(0, int(max) - 1))
 
-def run_actions(ctx, actions):
+def run_actions(ctx: Dict[str, Any], actions: List[Tuple[ecl.Action, List[str]]]) -> None:
     for act, args in actions:
+        if canceled(ctx): return
         act(ctx, *args)
 
 @make_builtin('<number> times <command>')
@@ -1,7 +1,11 @@
 import ecl
-import subprocess
+import os
+import re
+import subprocesses
+import threading
+import time
 import util
-from typing import Dict, List, Tuple, Optional
+from typing import Callable, Dict, List, Optional, Set, Tuple
 
 class Suggestions:
     literals: List[Tuple[List[str], bool]]
@@ -33,24 +37,125 @@ def literals_in_unit(unit: ecl.Unit) -> List[str]:
 def literals_in_param(param: ecl.Parameter) -> List[str]:
     return [x for unit, _ in param for x in literals_in_unit(unit)]
 
+def vocabulary(context: ecl.Context) -> Set[str]:
+    # all words the config could compare an input word to
+    v = set(['builtin'])
+    v.update(context.modes)
+    patterns = [p for aliases in context.modes.values() for p, _ in aliases] + list(context.enums.values()) + \
+        [p for p, _, _ in context.builtin_commands + context.global_builtins]
+    for p in patterns:
+        for form in p:
+            for param in form:
+                v.update(literals_in_param(param))
+    for aliases in context.modes.values():
+        for _, expansion in aliases:
+            v.update(plain_word.findall(expansion))
+    for value in context.script_vars.values():
+        v.update(plain_word.findall(value))
+    return v
+
+plain_word = re.compile(r'[\w.+-]+')
+
+class Search:
+    # what the get_suggestions calls for one list of suggestions share
+
+    def __init__(self, budget: float) -> None:
+        self.deadline = time.monotonic() + budget
+        self.continuations: Dict[Tuple[str, ...], Tuple[List[str], bool]] = {} # see definite_missing_arguments
+        self.vocabulary: Optional[Set[str]] = None
+        self.out_of_time = False
+
+    def over_budget(self) -> bool:
+        if not self.out_of_time and time.monotonic() > self.deadline:
+            self.out_of_time = True
+        return self.out_of_time
+
+    def inert(self, context: ecl.Context, word: str, before: List[str]) -> bool:
+        # whether matching can't tell word apart from other inert words, because it's
+        # a plain word that neither the config, the builtin types (other than <word>)
+        # nor the words before it mention. e.g. most file names are.
+        if self.vocabulary is None: self.vocabulary = vocabulary(context)
+        return (plain_word.fullmatch(word) is not None and word not in self.vocabulary and word not in before and
+            not any(f(word) for t, f in context.builtin_types.items() if t != 'word'))
+
+suggestion_budget = 0.5 # seconds per list of suggestions
+search_stats = (0, 0) # searches, ones that ran out of time
+stats_lock = threading.Lock() # for search_stats and completion_stats, since searches can run in several threads
+
 def definite_missing_arguments(
-        context: ecl.Context, goodwords, enabled_modes, handle_builtins: bool) -> Tuple[List[str], bool]:
+        context: ecl.Context, search: Search, goodwords, enabled_modes, handle_builtins: bool) -> Tuple[List[str], bool]:
+    # the same candidate often turns up for several types (e.g. left for <direction>
+    # and <hdir>), and inert ones (see Search.inert) all have the same continuation
+    # (which only ever consists of literals), so that e.g. 2000 file names cost one search
+    key = tuple(goodwords)
+    if search.inert(context, goodwords[-1], goodwords[:-1]): key = key[:-1] + ('',)
+    if key in search.continuations: return search.continuations[key]
     more: List[str] = []
     incomplete = True
-    while True:
+    while not search.over_budget(): # otherwise just leave it incomplete
         pr = context.match_commands(goodwords + more, enabled_modes, handle_builtins)
         if pr.longest == len(goodwords + more) and pr.error is None and pr.missing == []:
             incomplete = False
             break
         if pr.longest < len(goodwords) + len(more): break
         if pr.missing == [] or pr.error is not None: break
-        sugs = get_suggestions(context, goodwords + more, pr.missing, enabled_modes, handle_builtins)
+        sugs = suggest(context, search, goodwords + more, pr.missing, enabled_modes, handle_builtins)
         c = only_choice(sugs)
         if c is None: break
         more += c
+    search.continuations[key] = (more, incomplete)
     return (more, incomplete)
 
-def get_suggestions(context, goodwords, missing: List[ecl.Unit], enabled_modes, handle_builtins) -> Suggestions:
+def get_suggestions(context: ecl.Context, goodwords: List[str], missing: List[ecl.Unit], enabled_modes: List[ecl.Mode], handle_builtins: bool) -> Suggestions:
+    # within a time budget, after which candidates are no longer extended
+    global search_stats
+    search = Search(suggestion_budget)
+    with context.shared_evaluation(): # so that prefixes tried repeatedly are matched once
+        sugs = suggest(context, search, goodwords, missing, enabled_modes, handle_builtins)
+    with stats_lock:
+        searches, out_of_time = search_stats
+        search_stats = (searches + 1, out_of_time + search.out_of_time)
+    return sugs
+
+# the output of completions commands, by type, command and working directory:
+completion_cache: Dict[Tuple[ecl.Typename, str, str], Tuple[float, List[str]]] = {} # with when it was produced
+completion_ttl = 10.0 # seconds
+completion_timeout = 2.0 # seconds, per command
+completion_stats = (0, 0, 0, 0) # rounds, commands run, timed out, cache hits
+
+def invalidate_completions() -> None:
+    # e.g. when the working directory changes
+    completion_cache.clear()
+
+def provide_completions(context: ecl.Context, types: List[ecl.Typename]) -> Dict[ecl.Typename, List[str]]:
+    # runs the completions commands of types that aren't cached all at once
+    global completion_stats
+    rounds = run = timed_out = hits = 0 # added to completion_stats at the end
+    cwd = os.getcwd()
+    now = time.monotonic()
+    r = {}
+    todo = []
+    for t in types:
+        if t not in context.completions: continue
+        key = (t, context.completions[t], cwd)
+        if key in completion_cache and now - completion_cache[key][0] < completion_ttl:
+            r[t] = completion_cache[key][1]
+            hits += 1
+        else:
+            todo.append(key)
+    if todo:
+        rounds += 1
+        for key, result in zip(todo, subprocesses.runner.run_all([c for _, c, _ in todo], completion_timeout)):
+            r[key[0]] = result.output.strip().split('\n')
+            run += 1
+            if result.timed_out: timed_out += 1 # and not cached, since it's incomplete
+            else: completion_cache[key] = (now, r[key[0]])
+    with stats_lock:
+        all_rounds, all_run, all_timed_out, all_hits = completion_stats
+        completion_stats = (all_rounds + rounds, all_run + run, all_timed_out + timed_out, all_hits + hits)
+    return r
+
+def suggest(context: ecl.Context, search: Search, goodwords: List[str], missing: List[ecl.Unit], enabled_modes: List[ecl.Mode], handle_builtins: bool) -> Suggestions:
     sugs = Suggestions()
     sugs.literals = []
     sugs.types_with_sugs = []
@@ -68,21 +173,20 @@ def get_suggestions(context, goodwords, missing: List[ecl.Unit], enabled_modes,
             for form in context.enums[t]:
                 types_todo += types_in_param(form[0])
 
-    # find their completions:
+    # find their completions (which have timeouts of their own, so this doesn't count towards the budget):
+    started = time.monotonic()
+    provided = provide_completions(context, types_done)
+    search.deadline += time.monotonic() - started
     rt = []
     for type in types_done:
-        l: List[str] = []
-        if type in context.completions:
-            l = subprocess.Popen(context.completions[type], shell=True,
-                stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
-                stderr=subprocess.DEVNULL).stdout.read().decode('utf-8').strip().split('\n')
+        l: List[str] = list(provided.get(type, []))
         if type in context.enums:
             for form in context.enums[type]:
                 l += literals_in_param(form[0])
         if l != [] or type not in context.enums:
             ul: List[Tuple[List[str], bool]] = []
             for x in l:
-                more, incomplete = definite_missing_arguments(context, goodwords + [x], enabled_modes, handle_builtins)
+                more, incomplete = definite_missing_arguments(context, search, goodwords + [x], enabled_modes, handle_builtins)
                 ul.append(([x] + more, incomplete))
             rt.append((type, ul))
 
@@ -95,7 +199,7 @@ def get_suggestions(context, goodwords, missing: List[ecl.Unit], enabled_modes,
 
     # extend literals
     for x in lits:
-        y, incomplete = definite_missing_arguments(context, goodwords + [x], enabled_modes, handle_builtins)
+        y, incomplete = definite_missing_arguments(context, search, goodwords + [x], enabled_modes, handle_builtins)
         sugs.literals.append(([x] + y, incomplete))
 
     # partition types by whether they have suggestions:
@@ -104,6 +208,26 @@ def get_suggestions(context, goodwords, missing: List[ecl.Unit], enabled_modes,
 
     return sugs
 
+class LazySuggestions:
+    # get_suggestions, but only once they're needed (by whichever thread needs them first)
+
+    def __init__(self, context: ecl.Context, goodwords: List[str], missing: List[ecl.Unit], enabled_modes: List[ecl.Mode], handle_builtins: bool) -> None:
+        self.args = (context, list(goodwords), list(missing), list(enabled_modes), handle_builtins)
+        self.lock = threading.Lock()
+        self.value: Optional[Suggestions] = None
+
+    def get(self) -> Suggestions:
+        with self.lock: return self.compute()
+
+    def show(self, f: Callable[[Suggestions], None]) -> None:
+        # calls f with them while holding the lock, so that get waits until they've been shown
+        with self.lock: f(self.compute())
+
+    def compute(self) -> Suggestions:
+        # with self.lock held
+        if self.value is None: self.value = get_suggestions(*self.args)
+        return self.value
+
 def print_suggestions(eclc, suggestions: Suggestions):
     if len(suggestions.literals) == 1 and suggestions.types_with_sugs == [] and suggestions.types_without_sugs == []:
         print(eclc.colored("error: did you mean '" + ' '.join(suggestions.literals[0][0]) + "'?", 'red'))
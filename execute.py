@@ -1,10 +1,20 @@
 #!/usr/bin/env python3
 
+import actions
+import config
 import ecl
 import eclbuiltins
 import eclcompletion
+import feedback
+import keys
+import subprocesses
 import util
+import windows
+import asyncio
+import concurrent.futures
+import hashlib
 import os
+import pickle
 import subprocess
 import sys
 import shutil
@@ -14,38 +24,36 @@ from contextlib import contextmanager
 from ctypes import *
 import click
 import yaml
-from typing import Dict, List, Tuple, Optional
+from typing import IO, Any, Callable, Dict, FrozenSet, List, Set, Tuple, Optional
 
 os.environ['PYGAME_HIDE_SUPPORT_PROMPT'] = 'hide'
 
-class AutoEnableConfig: # for a given mode
-    always: bool
-    builtins: bool
-    other_modes: bool
-    for_prefixes: List[str]
-    for_suffixes: List[str]
-    for_applications: List[str]
-    for_leaf_applications: List[str]
-
 # config from files:
 configdir = ''
 numbers: Dict[str, str] = {}
-word_replacements: Dict[str, List[str]] = {}
+replacements = config.ReplacementNode()
 eclc = ecl.Context({}, {})
 short_mode_names: Dict[str, str] = {}
-auto_enable_cfg: Dict[ecl.Mode, AutoEnableConfig] = {}
+auto_enable_cfg: Dict[ecl.Mode, config.AutoEnableConfig] = {}
+auto_enable_index = config.AutoEnableIndex({})
 
 # options:
 prompt = True
 color = True
+engine = 'linear'
+window_tracker = 'auto' # see windows.make_tracker
+window_ttl = 0.5 # seconds
+idle_refresh = 0.0 # seconds; 0 means never
 
 # active application detection:
 current_windowtitle = ''
-current_windowprocesses = {}
+current_windowpid: Optional[int] = None
+current_windowprocesses: Dict = {} # see util.process_family
+current_windowapps = util.application_names({}) # see set_window_processes
 
 # evc state:
 mode: ecl.Mode = 'default'
-suggestions = None
+suggestions: Optional[eclcompletion.LazySuggestions] = None # for the previous line
 all_good_beep = None
 good_beep = None
 bad_beep = None
@@ -54,12 +62,11 @@ def colored(s: str, c: str) -> str:
     if not color: return s
     return termcolor.colored(s, c)
 
-def load_yaml(f: str):
-    with open(f, 'r') as stream:
-        return yaml.load(stream, yaml.CLoader)
+def parse_yaml(data: bytes) -> Any:
+    return yaml.load(data, yaml.CLoader)
 
-def read_auto_enable_config(cfg) -> AutoEnableConfig:
-    r = AutoEnableConfig()
+def read_auto_enable_config(cfg) -> config.AutoEnableConfig:
+    r = config.AutoEnableConfig()
     r.always = cfg.get('always', False)
     r.builtins = cfg.get('built-ins', True)
     r.other_modes = cfg.get('other-modes', True)
@@ -69,11 +76,62 @@ def read_auto_enable_config(cfg) -> AutoEnableConfig:
     r.for_suffixes = cfg.get('for-suffixes', [])
     return r
 
-def load_config():
-    global eclc, word_replacements, numbers
-    word_replacements = load_yaml(configdir + '/replacements.yaml')
-    numbers = load_yaml(configdir + '/numbers.yaml')
-    modes = load_yaml(configdir + '/modes.yaml')
+def compile_replacements(data: bytes) -> config.ReplacementNode:
+    # where several misrecognitions match at the same position, the one listed
+    # first wins, regardless of length. hence the priorities.
+    root = config.ReplacementNode()
+    priority = 0
+    for k, vv in parse_yaml(data).items():
+        for v in vv:
+            node = root
+            for w in v.split():
+                node = node.children.setdefault(w, config.ReplacementNode())
+            if node is not root and node.replacement is None:
+                node.replacement = (priority, k.split())
+            priority += 1
+    return root
+
+def load_replacements(x: config.ReplacementNode) -> None:
+    global replacements
+    replacements = x
+
+def load_numbers(x: Dict[str, str]) -> None:
+    global numbers
+    numbers = x
+
+# each input line goes through the stages listed in pipeline.yaml, which
+# modify the words in place. stages are made by the factories registered with
+# input_stage, from the argument given in pipeline.yaml (if any).
+
+Stage = Callable[[List[str]], None]
+stage_factories: Dict[str, Callable[[Any], Stage]] = {}
+stage_arg_types: Dict[str, Any] = {}
+default_pipeline = ['replacements', {'drop-leading': ['the', 'a', 'i', 'and']}, 'continue', 'pick-suggestion']
+
+pipeline: List[Tuple[str, Stage]] = []
+
+def compile_pipeline(data: bytes) -> List[Tuple[str, Any]]:
+    spec = parse_yaml(data)
+    if spec is None: spec = default_pipeline
+    if type(spec) is not list: raise Exception("pipeline.yaml is not a list")
+    r: List[Tuple[str, Any]] = []
+    for x in spec:
+        if type(x) is dict and len(x) != 1: raise Exception("pipeline.yaml: not a single stage: " + str(x))
+        name, arg = (next(iter(x.items())) if type(x) is dict else (x, None))
+        if name not in stage_factories: raise Exception("pipeline.yaml: no such stage: " + str(name))
+        arg_type = stage_arg_types[name]
+        if arg_type is None and arg is not None: raise Exception("pipeline.yaml: " + name + " takes no argument")
+        if arg_type is not None and type(arg) is not arg_type:
+            raise Exception("pipeline.yaml: " + name + " needs a " + arg_type.__name__)
+        r.append((name, arg))
+    return r
+
+def load_pipeline(x: List[Tuple[str, Any]]) -> None:
+    global pipeline
+    pipeline = [(name, stage_factories[name](arg)) for name, arg in x]
+
+def compile_modes(data: bytes) -> config.ModesConfig:
+    modes = parse_yaml(data)
 
     # handle enums:
     enums = {}
@@ -91,7 +149,7 @@ def load_config():
         del modes['<' + e + '>']
 
     # handle shortnames:
-    def remove_shortname(s):
+    def remove_shortname(s: str) -> str:
         i = s.find('(')
         return (s if i == -1 else s[:i].strip())
     new_short_mode_names = {}
@@ -113,40 +171,137 @@ def load_config():
         if cfg.always: always_on_modes.append(mode)
         if 'auto-enable' in aliases: del aliases['auto-enable']
 
-    # commit
+    r = config.ModesConfig()
+    r.modes = dict([(m, ecl.parse_aliases(a)) for m, a in modes.items()])
+    r.enums = enums
+    r.completions = new_completions
+    r.short_mode_names = new_short_mode_names
+    r.auto_enable_cfg = new_auto_enable_cfg
+    r.auto_enable_index = config.AutoEnableIndex(new_auto_enable_cfg)
+    r.always_on_modes = always_on_modes
+    return r
 
-    global short_mode_names, auto_enable_cfg
+def load_modes(x: config.ModesConfig) -> None:
+    global eclc, short_mode_names, auto_enable_cfg, auto_enable_index
 
-    eclc = ecl.Context(modes, enums)
+    eclc = ecl.Context(x.modes, x.enums)
 
     eclc.color = color
+    eclc.trie = (engine == 'trie')
     eclc.script_vars['configdir'] = configdir
     eclc.builtin_commands = eclbuiltins.builtin_commands
+    eclc.pure_builtins = eclbuiltins.pure_builtins
     eclc.global_builtins = eclbuiltins.global_builtins
     eclc.builtin_types = eclbuiltins.builtin_types
-    eclc.always_on_modes = always_on_modes
-    auto_enable_cfg = new_auto_enable_cfg
-    short_mode_names = new_short_mode_names
-    eclc.completions = new_completions
+    eclc.always_on_modes = x.always_on_modes
+    eclc.compute_first_sets()
+    auto_enable_cfg = x.auto_enable_cfg
+    auto_enable_index = x.auto_enable_index
+    short_mode_names = x.short_mode_names
+    eclc.completions = x.completions
+
+# for each config file, how to compile it and how to apply the result:
+config_loaders: Dict[str, Tuple[Callable[[bytes], Any], Callable[[Any], None]]] = {
+    'replacements.yaml': (compile_replacements, load_replacements),
+    'numbers.yaml': (parse_yaml, load_numbers),
+    'modes.yaml': (compile_modes, load_modes),
+    'pipeline.yaml': (compile_pipeline, load_pipeline),
+}
+optional_config_files = ['pipeline.yaml'] # missing ones are treated as empty
+
+# what we last loaded from each config file:
+config_stamps: Dict[str, Tuple[int, int]] = {} # (mtime, size)
+config_hashes: Dict[str, str] = {}
+config_reloads = 0
+config_compiles = 0 # files compiled rather than taken from the cache
+
+# compiled config files, keyed by file name, with the hash of their source:
+compiled_cache_file = '.compiled-config.pickle'
+compiled_cache_version = 5 # bump whenever the compiled representation changes
+compiled_cache: Optional[Dict[str, Tuple[str, Any]]] = None
+
+def read_compiled_cache() -> Dict[str, Tuple[str, Any]]:
+    try:
+        with open(configdir + '/' + compiled_cache_file, 'rb') as stream:
+            version, entries = pickle.load(stream)
+        if version == compiled_cache_version: return entries
+    except Exception:
+        pass # missing, stale or corrupt: we'll just recompile
+    return {}
+
+def write_compiled_cache(entries: Dict[str, Tuple[str, Any]]) -> None:
+    path = configdir + '/' + compiled_cache_file
+    try:
+        with open(path + '.tmp', 'wb') as stream:
+            pickle.dump((compiled_cache_version, entries), stream)
+        os.replace(path + '.tmp', path)
+    except OSError:
+        pass # e.g. read-only config dir
+
+def load_config() -> None:
+    # (re)loads only those config files that changed since the last call
+    global config_reloads, config_compiles, compiled_cache
+    if compiled_cache is None: compiled_cache = read_compiled_cache()
+    dirty = False
+    for f, (compile_file, apply) in config_loaders.items():
+        path = configdir + '/' + f
+        try:
+            st = os.stat(path)
+            stamp = (st.st_mtime_ns, st.st_size)
+        except FileNotFoundError:
+            if f not in optional_config_files: raise
+            stamp = (0, -1)
+        if config_stamps.get(f) == stamp: continue
+        data = b''
+        if stamp != (0, -1):
+            with open(path, 'rb') as stream:
+                data = stream.read()
+        h = hashlib.sha1(data).hexdigest()
+        if config_hashes.get(f) != h:
+            cached = compiled_cache.get(f)
+            if cached is not None and cached[0] == h:
+                compiled = cached[1]
+            else:
+                compiled = compile_file(data)
+                config_compiles += 1
+                compiled_cache[f] = (h, compiled)
+                dirty = True
+            apply(compiled)
+            if f in config_hashes: config_reloads += 1
+            config_hashes[f] = h
+        config_stamps[f] = stamp
+    if dirty: write_compiled_cache(compiled_cache)
+
+@eclbuiltins.make_functional_builtin('config reloads')
+def cmd_config_reloads(*_: Any) -> str:
+    return str(config_reloads)
+
+@eclbuiltins.make_functional_builtin('config compiles')
+def cmd_config_compiles(*_: Any) -> str:
+    return str(config_compiles)
 
 cmdline_modes: List[str] = []
-def mode_is_auto_enabled(candidate: ecl.Mode) -> bool:
-    if candidate in cmdline_modes: return True
-    c = auto_enable_cfg[candidate]
-    if c.always: return True
-    for app in c.for_applications:
-        if util.occurs_in_branch(app, current_windowprocesses): return True
-    for app in c.for_leaf_applications:
-        if util.occurs_as_leaf_in_branch(app, current_windowprocesses): return True
-    for prefix in c.for_prefixes:
-        if current_windowtitle.startswith(prefix): return True
-    for suffix in c.for_suffixes:
-        if current_windowtitle.endswith(suffix): return True
-    return False
+
+def set_window_processes(processes: Dict, apps: Tuple[FrozenSet[str], FrozenSet[str]]) -> None:
+    # apps is util.application_names(processes)
+    global current_windowprocesses, current_windowapps
+    current_windowprocesses = processes
+    current_windowapps = apps
+
+# what get_active_modes last returned, and what it depended on:
+active_modes_memo: Tuple[Any, List[ecl.Mode]] = (None, [])
 
 def get_active_modes() -> List[str]:
-    return [mode] + [m for m in eclc.modes if m != mode and mode_is_auto_enabled(m)]
-        # important: mode itself comes first
+    global active_modes_memo
+    key = (mode, current_windowtitle, current_windowapps, auto_enable_index, tuple(cmdline_modes))
+    if active_modes_memo[0] != key:
+        auto = auto_enable_index.modes_for(current_windowtitle, current_windowapps)
+        auto.update(cmdline_modes)
+        auto.discard(mode)
+        order = auto_enable_index.order
+        active_modes_memo = (key, [mode] + sorted([m for m in auto if m in order], key=order.__getitem__))
+            # important: mode itself comes first
+    return list(active_modes_memo[1])
 
 @eclbuiltins.make_functional_builtin('get active modes')
 def cmd_get_active_modes(*_):
@@ -154,24 +309,114 @@ def cmd_get_active_modes(*_):
 
 def color_mode(m: ecl.Mode) -> str: return colored(m, 'cyan')
 
-# input preprocessing:
-
-def replace_numbers(words: List[str], collected=''):
-    if not words: return ([collected] if collected != '' else [])
-    first, *rest = words
-    if first in numbers: return replace_numbers(rest, collected + numbers[first])
-    if collected != '': return [collected, first] + replace_numbers(rest)
-    return [first] + replace_numbers(rest)
-
-def replace_words(words: List[str]) -> List[str]:
-    if not words: return []
-    for i in range(0, len(words)):
-        for k, vv in word_replacements.items():
-            for v in vv:
-                kw = v.split()
-                if len(words) >= i + len(kw) and words[i:i+len(kw)] == kw:
-                    return words[:i] + k.split() + replace_words(words[i+len(kw):])
-    return words
+# input preprocessing (see pipeline.yaml):
+
+stage_stats: Dict[str, Tuple[int, float]] = {} # runs and total seconds, by stage
+
+def input_stage(name: str, arg_type: Any = None) -> Callable[[Callable[[Any], Stage]], Callable[[Any], Stage]]:
+    # arg_type is that of the argument the stage needs (list or dict), if any
+    def f(factory: Callable[[Any], Stage]) -> Callable[[Any], Stage]:
+        stage_factories[name] = factory
+        stage_arg_types[name] = arg_type
+        return factory
+    return f
+
+def preprocess(words: List[str]) -> None:
+    for name, stage in pipeline:
+        start = time.perf_counter()
+        stage(words)
+        runs, total = stage_stats.get(name, (0, 0.0))
+        stage_stats[name] = (runs + 1, total + time.perf_counter() - start)
+
+@eclbuiltins.make_functional_builtin('pipeline statistics')
+def cmd_pipeline_statistics(*_: Any) -> str:
+    return '\n'.join(name + ': ' + str(runs) + ' runs, %.3f ms' % (total * 1000)
+                     for name, (runs, total) in stage_stats.items())
+
+def normalize_words(words: List[str]) -> List[str]:
+    # replaces misrecognitions (see config.ReplacementNode) and then folds numbers,
+    # in a single pass over words
+    r: List[str] = []
+    collected = ''
+    i = 0
+    while i < len(words):
+        best: Optional[Tuple[int, List[str]]] = None
+        end = i + 1
+        node = replacements
+        j = i
+        while j < len(words):
+            child = node.children.get(words[j])
+            if child is None: break
+            node = child
+            j += 1
+            if node.replacement is not None and (best is None or node.replacement[0] < best[0]):
+                best = node.replacement
+                end = j
+        for w in ([words[i]] if best is None else best[1]):
+            if w in numbers:
+                collected += numbers[w]
+                continue
+            if collected != '': r.append(collected); collected = ''
+            r.append(w)
+        i = end
+    if collected != '': r.append(collected)
+    return r
+
+@input_stage('replacements')
+def replacements_stage(_: None) -> Stage:
+    # replacements.yaml and numbers.yaml
+    def f(words: List[str]) -> None:
+        words[:] = normalize_words(words)
+    return f
+
+@input_stage('drop-leading', list)
+def drop_leading_stage(fillers: List[str]) -> Stage:
+    # drops the first word if it is one of fillers
+    fillerset = set(fillers)
+    def f(words: List[str]) -> None:
+        if words and words[0] in fillerset: del words[0]
+    return f
+
+@input_stage('drop', list)
+def drop_stage(stopwords: List[str]) -> Stage:
+    # drops every occurrence of the stopwords
+    stopset = set(stopwords)
+    def f(words: List[str]) -> None:
+        j = 0
+        for w in words:
+            if w not in stopset:
+                words[j] = w
+                j += 1
+        del words[j:]
+    return f
+
+@input_stage('fold', dict)
+def fold_stage(folds: Dict[str, str]) -> Stage:
+    # replaces single words, e.g. spoken punctuation: {comma: ','}
+    def f(words: List[str]) -> None:
+        for i, w in enumerate(words):
+            x = folds.get(w)
+            if x is not None: words[i] = x
+    return f
+
+@input_stage('pick-suggestion')
+def pick_suggestion_stage(_: None) -> Stage:
+    # replaces e.g. 'yes 2' by the second suggestion made for the previous line
+    def f(words: List[str]) -> None:
+        global suggestions
+        if not words or suggestions is None or not looks_like_pick(words): return
+        p = maybe_pick_suggestion(words, eclcompletion.linear_suggestions(suggestions.get()))
+        if p is not None:
+            words[:] = successful_input + p
+            suggestions = None
+    return f
+
+@input_stage('continue')
+def continue_stage(_: None) -> Stage:
+    # replaces a leading 'continue' by the part of the previous line that was a valid command
+    def f(words: List[str]) -> None:
+        if words[:1] == ['continue']: words[:1] = successful_input
+    return f
 
 def eval_command(words: List[str], line: str, enabled_modes: List[ecl.Mode], ignore_0match):
     global suggestions, mode
@@ -186,25 +431,63 @@ def eval_command(words: List[str], line: str, enabled_modes: List[ecl.Mode], ign
         return 0
 
     if pr.longest != 0 and pr.missing:
-        suggestions = eclcompletion.get_suggestions(eclc, words[:pr.longest], pr.missing, enabled_modes, handle_builtins)
-    c = confirm_input(words, pr, line, ignore_0match)
+        suggestions = eclcompletion.LazySuggestions(eclc, words[:pr.longest], pr.missing, enabled_modes, handle_builtins)
+            # computed when shown (by the suggester, after the feedback) or picked from
+    prp = prompt_string()
+    sugs = suggestions
     if pr.new_mode is not None:
         mode = pr.new_mode
+    if any(f is cmd_stop_actions for f, _ in pr.actions):
+        executor.cancel()
+
+    def run() -> None:
+        # the matching is done; showing the result and acting on it can wait
+        c = confirm_input(words, pr, line, ignore_0match, prp, sugs)
+        ctx = {"enabled_modes": enabled_modes, 'ecl': eclc}
+        attempt = None
+        try:
+            for f, w in pr.actions:
+                if executor.canceled(): break
+                attempt = w
+                executor.run_action(ctx, f, w)
+        except Exception as e:
+            if attempt is not None:
+                print(colored(' '.join(attempt) + ": " + str(e), 'red'))
+
+        if c and prompt: util.clear_line()
+
+    executor.submit(run)
+    if any(f in eclbuiltins.stateful_builtins for f, _ in pr.actions):
+        # so that the next line (and the dictation check) sees what it did; modes
+        # needn't be waited for, since they change when the line is matched
+        executor.wait()
+    return pr.longest
 
-    ctx = {"enabled_modes": enabled_modes, 'ecl': eclc}
-    attempt = None
-    try:
-        for f, w in pr.actions:
-            attempt = w
-            f(ctx, *w)
-    except Exception as e:
-        if attempt is not None:
-            print(colored(' '.join(attempt) + ": " + str(e), 'red'))
+# actions run in order, but (once process_lines starts it) in a thread of
+# their own, so that slow ones don't hold up the matching of later lines
+# (unless they're stateful, see eval_command):
+executor = actions.Executor()
 
-    if c and prompt: util.clear_line()
-    return pr.longest
+@eclbuiltins.make_builtin('stop actions')
+def cmd_stop_actions(*_: Any) -> None:
+    pass # eval_command cancels earlier actions before queueing this one
+
+@eclbuiltins.make_builtin('action statistics')
+def cmd_action_statistics(*_: Any) -> None:
+    print(executor.statistics())
+
+@eclbuiltins.make_builtin('feedback statistics')
+def cmd_feedback_statistics(*_: Any) -> None:
+    util.print_line(feedback.player.statistics())
 
 ignore_lines = ['', 'if']
+successful_input: List[str] = [] # of the previous line
+
+def looks_like_pick(words: List[str]) -> bool:
+    # whether maybe_pick_suggestion could pick something, whatever the suggestions
+    return (words == ['yes'] or (len(words) == 1 and words[0].isdigit()) or
+        (len(words) == 3 and words[:2] == ['yes', 'the']) or
+        (len(words) == 2 and words[0] == 'yes' and words[1].isdigit()))
 
 def maybe_pick_suggestion(words: List[str], linsugs: List[List[str]]) -> Optional[List[str]]:
     i = -1
@@ -215,64 +498,168 @@ def maybe_pick_suggestion(words: List[str], linsugs: List[List[str]]) -> Optiona
         i = int(words[1]) - 1
     return (linsugs[i] if 0 <= i and i < len(linsugs) else None)
 
+# how long lines waited between arriving and being evaluated:
+input_latency = (0, 0.0, 0.0) # lines, total seconds, max seconds
+
+@eclbuiltins.make_functional_builtin('input latency')
+def cmd_input_latency(*_: Any) -> str:
+    n, total, worst = input_latency
+    return (str(n) + ' lines, mean %.3f ms, max %.3f ms' % (total / max(n, 1) * 1000, worst * 1000))
+
+# the active window and its processes are looked at when a line arrives and
+# what we know is older than window_ttl, when an event-driven tracker reports
+# a change, and (if idle_refresh is set) every idle_refresh seconds:
+snapshot_retakes = 2 # at most, when the window changed while a snapshot was being taken
+snapshots_taken = 0
+utterances_processed = 0
+
+@eclbuiltins.make_builtin('completion statistics') # an action, so that it counts the searches of the lines before
+def cmd_completion_statistics(*_: Any) -> None:
+    wait_for_suggestions()
+    with eclcompletion.stats_lock:
+        rounds, run, timed_out, hits = eclcompletion.completion_stats
+        searches, out_of_time = eclcompletion.search_stats
+    util.print_line(str(rounds) + ' rounds, ' + str(run) + ' commands run, ' + str(timed_out) +
+        ' timed out, ' + str(hits) + ' cache hits; ' + str(searches) + ' searches, ' +
+        str(out_of_time) + ' out of time')
+
+@eclbuiltins.make_builtin('window processes') # as of the latest snapshot (see take_window_snapshot)
+def cmd_window_processes(*_: Any) -> None:
+    util.print_line('  ' + util.print_pstree(current_windowprocesses, 2))
+
+@eclbuiltins.make_functional_builtin('window statistics')
+def cmd_window_statistics(*_: Any) -> str:
+    return str(snapshots_taken) + ' snapshots, ' + str(utterances_processed) + ' utterances'
+
+def take_window_snapshot(tracker: windows.Tracker) -> Tuple[windows.Window, Dict, Tuple[FrozenSet[str], FrozenSet[str]], Optional[str]]:
+    # the slow part of tracking the active window, done off the event loop
+    tracker.poll()
+    w = tracker.window
+    processes = ({} if w[1] is None else util.process_family(w[1]))
+    return (w, processes, util.application_names(processes), util.cwd_of_branch(processes))
+
+def read_lines(input: IO, loop: asyncio.AbstractEventLoop, queue: asyncio.Queue) -> None:
+    # runs in its own thread, so that lines get timestamped when they arrive
+    # even if the event loop is busy
+    stream = getattr(input, 'buffer', input)
+    while True:
+        line_bytes = stream.readline()
+        loop.call_soon_threadsafe(queue.put_nowait, (time.perf_counter(), line_bytes))
+        if not line_bytes: break # EOF
+
 async def process_lines(input):
-    import asyncio
-    global current_windowtitle, current_windowprocesses, suggestions
+    # lines are read in a thread, matched here against a snapshot of the active
+    # window that is at most window_ttl old (see take_window_snapshot), and
+    # then acted on by the executor
+    import threading
+    global successful_input, input_latency, utterances_processed, suggester
     loop = asyncio.get_event_loop()
-    reader = asyncio.StreamReader(loop=loop, limit=asyncio.streams._DEFAULT_LIMIT) # type: ignore
-    await loop.connect_read_pipe(
-        lambda: asyncio.StreamReaderProtocol(reader, loop=loop), input)
+    worker = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        # just one, because the trackers and util.process_table aren't thread-safe
 
     if prompt: print_prompt()
     last_active_modes = get_active_modes()
-
-    successful_input: List[str] = []
+    snapshot_time = float('-inf')
+    changes = 0 # reported by event-driven trackers
+    refreshing: Optional[asyncio.Future] = None
+
+    async def take_snapshot() -> None:
+        nonlocal last_active_modes, snapshot_time
+        global current_windowtitle, current_windowpid, snapshots_taken
+        for _ in range(snapshot_retakes + 1):
+            started, seen = time.monotonic(), changes
+            w, processes, apps, cwd = await loop.run_in_executor(worker, take_window_snapshot, tracker)
+            snapshots_taken += 1
+            if changes == seen: break # otherwise it may be outdated already
+        # a window that keeps changing (e.g. a clock in its title) mustn't hold
+        # up the lines waiting for this, so they make do with the last retake,
+        # which is considered stale:
+        snapshot_time = (started if changes == seen else float('-inf'))
+        current_windowtitle, current_windowpid = w
+        set_window_processes(processes, apps)
+        if cwd is not None and cwd != os.getcwd():
+            try:
+                os.chdir(cwd)
+                eclcompletion.invalidate_completions()
+            except FileNotFoundError: pass
+            except PermissionError: pass
+        m = get_active_modes()
+        if last_active_modes != m:
+            last_active_modes = m
+            if prompt:
+                util.clear_line()
+                print_prompt()
+
+    def refresh() -> asyncio.Future:
+        # joins the snapshot being taken, if any
+        nonlocal refreshing
+        if refreshing is None or refreshing.done():
+            refreshing = asyncio.ensure_future(take_snapshot())
+        return refreshing
+
+    async def refresh_if_stale() -> None:
+        if time.monotonic() - snapshot_time > window_ttl:
+            await refresh()
+
+    loop_thread = threading.get_ident()
+
+    def window_changed(_: windows.Window) -> None:
+        nonlocal snapshot_time, changes
+        if threading.get_ident() != loop_thread: return # polled, by take_window_snapshot
+        snapshot_time = float('-inf')
+        changes += 1
+        refresh() # cheap to notice, so we might as well update the prompt
+
+    async def refresh_when_idle() -> None:
+        while True:
+            await asyncio.sleep(idle_refresh)
+            await refresh_if_stale()
+
+    tracker = windows.make_tracker(window_tracker)
+    tracker.start(loop, window_changed)
+    await refresh()
+    idle_task = (loop.create_task(refresh_when_idle()) if idle_refresh > 0 else None)
+
+    lines: asyncio.Queue = asyncio.Queue()
+    executor.start(lambda: loop.call_soon_threadsafe(lines.put_nowait, (0.0, b'')),
+        lambda e: util.print_line(colored('error: ' + str(e), 'red')))
+    suggester = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    threading.Thread(target=read_lines, args=(input, loop, lines), daemon=True).start()
 
     while True:
-        try:
-            line_bytes = await asyncio.wait_for(reader.readline(), 0.5)
-        except asyncio.TimeoutError:
-            current_windowtitle, current_windowprocesses = util.get_current_application()
-            x = util.cwd_of_branch(current_windowprocesses)
-            if x is not None:
-                try: os.chdir(x)
-                except FileNotFoundError: pass
-                except PermissionError: pass
-            m = get_active_modes()
-            if last_active_modes != m:
-                last_active_modes = m
-                if prompt:
-                    util.clear_line()
-                    print_prompt()
-        else:
-            if not line_bytes: break # EOF
-            line: str = line_bytes.decode('utf-8').rstrip('\n')
-            if line in ignore_lines or line[0] == '#': continue
+        arrived, line_bytes = await lines.get()
+        if not line_bytes: break # EOF
+        line: str = line_bytes.decode('utf-8').rstrip('\n')
+        if line in ignore_lines or line[0] == '#': continue
 
-            try:
-                load_config()
-            except Exception as e:
-                print("\nerror loading config:", e)
-
-            words = replace_numbers(replace_words(line.split()))
-            if len(words) > 0 and words[0] in ['the', 'a', 'i', 'and']:
-                words.pop(0)
-            if words:
-                if words[0] == 'continue': words = successful_input + words[1:]
-                elif suggestions is not None:
-                    p = maybe_pick_suggestion(words, eclcompletion.linear_suggestions(suggestions))
-                    if p is not None:
-                        words = successful_input + p
-                        suggestions = None
-                enabled_modes = get_active_modes()
-                longest = eval_command(words, line, enabled_modes, True)
-                if longest != 0:
-                    successful_input = words[:longest]
-                elif "dictation" in eclc.script_vars and eclc.script_vars["dictation"] == "true":
-                    eval_command(["builtin", "text"] + words, "builtin text " + line,
-                        enabled_modes, True)
-                if prompt: print_prompt()
-                last_active_modes = get_active_modes()
+        try:
+            load_config()
+        except Exception as e:
+            print("\nerror loading config:", e)
+
+        words = line.split()
+        preprocess(words)
+        if words:
+            await refresh_if_stale()
+            utterances_processed += 1
+            enabled_modes = get_active_modes()
+            n, total, worst = input_latency
+            waited = time.perf_counter() - arrived
+            input_latency = (n + 1, total + waited, max(worst, waited))
+            longest = eval_command(words, line, enabled_modes, True)
+            if longest != 0:
+                successful_input = words[:longest]
+            elif "dictation" in eclc.script_vars and eclc.script_vars["dictation"] == "true":
+                eval_command(["builtin", "text"] + words, "builtin text " + line,
+                    enabled_modes, True)
+            if prompt: executor.submit(print_prompt)
+            last_active_modes = get_active_modes()
+
+    await loop.run_in_executor(None, executor.wait)
+    await loop.run_in_executor(None, wait_for_suggestions)
+    if idle_task is not None: idle_task.cancel()
+    worker.shutdown(wait=False)
+    if executor.exit is not None: raise executor.exit
 
 def short_mode_name(mode: ecl.Mode) -> str:
     return (short_mode_names[mode] if mode in short_mode_names else mode)
@@ -290,33 +677,71 @@ def prompt_string() -> str:
         mm.append('*')
     return ','.join(mm) + '> '
 
-def print_prompt():
-    print(prompt_string(), end='')
-    sys.stdout.flush()
+prompt_showing = False # whether the prompt is waiting for input (see show_suggestions)
+
+def print_prompt() -> None:
+    global prompt_showing
+    with util.output_lock:
+        sys.stdout.write(prompt_string())
+        sys.stdout.flush()
+        prompt_showing = True
 
-def confirm_input(words: List[str], pr, original_input, ignore_0match):
+def write_frame(parts: List[str]) -> None:
+    # all at once, so that it's neither interleaved with other output nor drawn piecemeal
+    global prompt_showing
+    with util.output_lock:
+        sys.stdout.write(''.join(parts))
+        sys.stdout.flush()
+        prompt_showing = False
+
+# suggestions are searched for and shown in a thread of their own (once
+# process_lines starts it), so that later lines' actions needn't wait for that:
+suggester: Optional[concurrent.futures.ThreadPoolExecutor] = None
+
+def show_suggestions(sugs: eclcompletion.LazySuggestions) -> None:
+    def show(s: eclcompletion.Suggestions) -> None:
+        # above the prompt, if a later line's is showing already
+        with util.output_lock:
+            if prompt_showing: sys.stdout.write(util.clear_line_code())
+            eclcompletion.print_suggestions(eclc, s)
+            if prompt_showing: sys.stdout.write(prompt_string())
+            sys.stdout.flush()
+    def work() -> None:
+        try:
+            sugs.show(show) # a pick from them waits for this (see LazySuggestions.show)
+        except Exception as e:
+            util.print_line(colored('error: ' + str(e), 'red'))
+    if suggester is None: sugs.show(show)
+    else: suggester.submit(work)
+
+def wait_for_suggestions() -> None:
+    # until those submitted so far have been shown
+    if suggester is not None: suggester.submit(lambda: None).result()
+
+def confirm_input(words: List[str], pr, original_input, ignore_0match, prp: str,
+        sugs: Optional[eclcompletion.LazySuggestions]):
     n = pr.longest
     cols = shutil.get_terminal_size().columns
-    prp = prompt_string()
-    printed = ''
     if ignore_0match and (n == 0 or (n == 1 and pr.missing and words[0].isdigit())):
-        if prompt: util.clear_line()
-        print(prp + colored(util.truncate(original_input, cols - len(util.strip_markup(prp))), 'yellow'), end='\r')
-        sys.stdout.flush()
+        write_frame([(util.clear_line_code() if prompt else ''), prp,
+            colored(util.truncate(original_input, cols - len(util.strip_markup(prp))), 'yellow'), '\r'])
         return False
-    if prompt:
-        util.clear_line()
-        printed = prp
-        print(printed, end='')
-        sys.stdout.flush()
+
+    all_good = (n == len(words) and not pr.missing and pr.error is None)
+
+    # a beep per good word, and then a bad one if not all of it was good:
+    sounds: List[Any] = []
+    if all_good:
+        if all_good_beep is not None: sounds.append(all_good_beep)
+    else:
+        if good_beep is not None: sounds += [good_beep] * n
+        if bad_beep is not None: sounds.append(bad_beep)
+    if sounds: feedback.player.play(sounds)
 
     if prompt:
-        needed = 0
-        i = 0
-        while i < n:
-            needed += len(words[i])
-            if i + 1 < n: needed += len(' ')
-            i += 1
+        frame = [util.clear_line_code(), prp]
+        printed = prp
+        needed = len(' '.join(words[:n]))
         if n != len(words):
             if n != 0: needed += len(' ')
             needed += 5
@@ -324,44 +749,23 @@ def confirm_input(words: List[str], pr, original_input, ignore_0match):
             needed += len(' ???')
         avail = cols - len(util.strip_markup(printed))
         if needed > avail:
-            print('\n  ', end='')
+            frame.append('\n  ')
             printed = '  '
-
-    all_good = (n == len(words) and not pr.missing and pr.error is None)
-
-    if all_good:
-        if all_good_beep is not None:
-            all_good_beep.play()
-    elif good_beep is not None and n != 0:
-        good_beep.play(n - 1)
-
-    i = 0
-    while i < n:
-        if prompt:
-            x = colored(words[i], 'green')
-            if i + 1 < n: x += ' '
-            print(x, end='')
-            sys.stdout.flush()
-            printed += x
-        if not all_good and good_beep is not None:
-            time.sleep(good_beep.get_length())
-        i += 1
-
-    if not all_good and bad_beep is not None:
-        bad_beep.play()
-
-    if prompt:
+        x = ' '.join(colored(w, 'green') for w in words[:n])
+        frame.append(x)
+        printed += x
         if n != len(words):
             if n != 0:
-                print(' ', end='')
+                frame.append(' ')
                 printed += ' '
             avail = cols - len(util.strip_markup(printed))
-            print(colored(util.truncate(' '.join(words[n:]), avail), 'red'), end='')
+            frame.append(colored(util.truncate(' '.join(words[n:]), avail), 'red'))
         elif pr.missing:
             # if all words were consumed but evaluation still went bad,
             # it means additional input was missing
-            print(colored(' ???', 'red'), end='')
-        print()
+            frame.append(colored(' ???', 'red'))
+        frame.append('\n')
+        write_frame(frame)
 
     if pr.error is not None:
         print()
@@ -375,8 +779,8 @@ def confirm_input(words: List[str], pr, original_input, ignore_0match):
             print(s, end='')
     elif n != len(words) and pr.missing == ['<command>']:
         print(colored('error: no such command', 'red'))
-    elif suggestions is not None:
-        eclcompletion.print_suggestions(eclc, suggestions)
+    elif sugs is not None:
+        show_suggestions(sugs)
     else:
         problem = ('missing' if n == len(words) else 'expected')
         problem += ' ' + ' or '.join(map(eclc.render_unit, list(set(pr.missing))))
@@ -432,6 +836,25 @@ home_dir: str = opt_home_dir
 @click.option('--modes', default='default', type=str, show_default=True)
 @click.option('--appdir', default=os.getenv('PWD'), type=str, show_default=True)
 @click.option('--configdir', default=home_dir + '/.evc-voice-commander',type=str, show_default=True)
+@click.option('--engine', default='linear', type=click.Choice(['linear', 'trie']), show_default=True)
+@click.option('--windows', 'window_tracker', default='auto', type=str, show_default=True)
+    # auto, xlib, xdotool or fake:<file> (see windows.make_tracker)
+@click.option('--window-ttl', default=0.5, type=float, show_default=True)
+    # how old the info about the active window may be when a line is evaluated
+@click.option('--idle-refresh', default=0.0, type=float, show_default=True)
+    # how often to look at the active window when no lines come in (0: never)
+@click.option('--keys', 'key_backend', default='auto', type=str, show_default=True)
+    # auto, xdotool, pyautogui or record (see keys.make_backend)
+@click.option('--key-delay', default=0.012, type=float, show_default=True)
+    # seconds between injected key events
+@click.option('--execute-timeout', default=60.0, type=float, show_default=True)
+    # seconds after which 'execute' gives up on a command
+@click.option('--max-children', default=8, type=int, show_default=True)
+    # how many subprocesses that are waited for may run at once
+@click.option('--completion-ttl', default=10.0, type=float, show_default=True)
+    # how long the output of completions commands is reused for, in seconds
+@click.option('--suggestion-budget', default=0.5, type=float, show_default=True)
+    # seconds after which suggestions are no longer extended
 @click.option('--dryrun', default=False, type=bool, is_flag=True, show_default=True)
 @click.option('--volume', default=(0 if sys.stdin.isatty() else 0.1), type=float, show_default=True)
     # stdin not being a tty is interpreted to mean the input is coming
@@ -439,7 +862,7 @@ home_dir: str = opt_home_dir
     # (a) non-obnoxious, and
     # (b) won't interfere with speech recognition.
 @click.argument('cmd', nargs=-1)
-def evc(color, prompt, modes, configdir, appdir, dryrun, volume, cmd):
+def evc(color, prompt, modes, configdir, appdir, engine, window_tracker, window_ttl, idle_refresh, key_backend, key_delay, execute_timeout, max_children, completion_ttl, suggestion_budget, dryrun, volume, cmd):
     global cmdline_modes, mode
 
     cmdline_modes = modes.split(',')
@@ -447,7 +870,16 @@ def evc(color, prompt, modes, configdir, appdir, dryrun, volume, cmd):
     globals()['color'] = color
     globals()['configdir'] = configdir
     globals()['appdir'] = appdir
+    globals()['engine'] = engine
+    globals()['window_tracker'] = window_tracker
+    globals()['window_ttl'] = window_ttl
+    globals()['idle_refresh'] = idle_refresh
     eclbuiltins.dryrun = dryrun
+    eclbuiltins.key_backend = keys.make_backend(key_backend, key_delay)
+    eclbuiltins.execute_timeout = execute_timeout
+    subprocesses.runner.max_children = max_children
+    eclcompletion.completion_ttl = completion_ttl
+    eclcompletion.suggestion_budget = suggestion_budget
     globals()['prompt'] = prompt
 
     initial_words = list(cmd)
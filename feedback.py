@@ -0,0 +1,61 @@
+# Beeps for evaluated lines, played without being waited for: a sequence of
+# sounds is handed to a thread of its own, which starts each one when the
+# ones before it are done, so that the line's actions needn't wait for them.
+#
+# Sounds are anything with play() and get_length() (in seconds), such as
+# pygame Sounds (see beeps.py).
+
+import threading
+import time
+from typing import Any, List, Optional, Tuple
+
+class Player:
+
+    def __init__(self) -> None:
+        self.cond = threading.Condition()
+        self.pending: List[Tuple[float, Any]] = [] # (when, sound), in order
+        self.thread: Optional[threading.Thread] = None # started on first use
+        self.played = 0
+        self.dropped = 0 # sounds of sequences that a newer one replaced
+
+    def play(self, sounds: List[Any]) -> None:
+        # replaces whatever is left of the previous sequence
+        with self.cond:
+            self.dropped += len(self.pending)
+            when = time.monotonic()
+            self.pending = []
+            for sound in sounds:
+                self.pending.append((when, sound))
+                when += sound.get_length()
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.work, daemon=True)
+                self.thread.start()
+            self.cond.notify_all()
+
+    def wait(self) -> None:
+        # until every sound has been started
+        with self.cond:
+            while self.pending: self.cond.wait()
+
+    def work(self) -> None:
+        while True:
+            with self.cond:
+                while not self.pending: self.cond.wait()
+                when, sound = self.pending[0]
+                delay = when - time.monotonic()
+                if delay > 0:
+                    self.cond.wait(delay) # or until replaced
+                    continue
+                del self.pending[0]
+                late = time.monotonic() - when
+                if late > 0: # so the rest is too (rather than overlapping it)
+                    self.pending = [(t + late, s) for t, s in self.pending]
+                sound.play() # doesn't block, so holding the lock is fine (and keeps late accurate)
+                self.played += 1
+                self.cond.notify_all()
+
+    def statistics(self) -> str:
+        with self.cond:
+            return str(self.played) + ' sounds played, ' + str(self.dropped) + ' dropped'
+
+player = Player()
@@ -0,0 +1,97 @@
+# Injection of key events, in batches (e.g. all of a 'press' command's
+# chords, or a whole 'text'), so that backends that have a fixed cost per
+# call can pay it once per batch rather than once per key.
+#
+# Keys are named as in pyautogui (see eclbuiltins.key_by_name). Events are
+# (key, down) pairs.
+
+import itertools
+import os
+import re
+import shutil
+import subprocess
+import util
+from typing import Any, List, Tuple
+
+Event = Tuple[str, bool]
+
+class PyautoguiBackend:
+    # the fallback: a pyautogui call (and a delay) per key
+
+    def __init__(self, delay: float) -> None:
+        import pyautogui # type: ignore
+        self.pyautogui = pyautogui
+        self.delay = delay
+        pyautogui.PAUSE = delay
+
+    def type(self, text: str) -> None:
+        self.pyautogui.press(list(text), interval=self.delay)
+
+    def keys(self, events: List[Event]) -> None:
+        for key, down in events:
+            if down: self.pyautogui.keyDown(key)
+            else: self.pyautogui.keyUp(key)
+
+# pyautogui key names that aren't X keysym names:
+xdotool_names = {
+    'enter': 'Return', 'return': 'Return', '\n': 'Return', 'esc': 'Escape', 'escape': 'Escape',
+    'backspace': 'BackSpace', 'tab': 'Tab', '\t': 'Tab', 'space': 'space', ' ': 'space',
+    'ctrl': 'Control_L', 'ctrlleft': 'Control_L', 'ctrlright': 'Control_R',
+    'shift': 'Shift_L', 'shiftleft': 'Shift_L', 'shiftright': 'Shift_R',
+    'alt': 'Alt_L', 'altleft': 'Alt_L', 'altright': 'Alt_R',
+    'win': 'Super_L', 'winleft': 'Super_L', 'winright': 'Super_R',
+    'up': 'Up', 'down': 'Down', 'left': 'Left', 'right': 'Right',
+    'pageup': 'Prior', 'pgup': 'Prior', 'pagedown': 'Next', 'pgdn': 'Next',
+    'home': 'Home', 'end': 'End', 'insert': 'Insert', 'delete': 'Delete', 'del': 'Delete',
+    'capslock': 'Caps_Lock', 'printscreen': 'Print', 'menu': 'Menu', 'apps': 'Menu',
+    'volumeup': 'XF86AudioRaiseVolume', 'volumedown': 'XF86AudioLowerVolume',
+    'volumemute': 'XF86AudioMute', 'playpause': 'XF86AudioPlay',
+    'nexttrack': 'XF86AudioNext', 'prevtrack': 'XF86AudioPrev',
+    '!': 'exclam', '"': 'quotedbl', '#': 'numbersign', '$': 'dollar', '%': 'percent',
+    '&': 'ampersand', "'": 'apostrophe', '(': 'parenleft', ')': 'parenright',
+    '*': 'asterisk', '+': 'plus', ',': 'comma', '-': 'minus', '.': 'period', '/': 'slash',
+    ':': 'colon', ';': 'semicolon', '<': 'less', '=': 'equal', '>': 'greater',
+    '?': 'question', '@': 'at', '[': 'bracketleft', '\\': 'backslash', ']': 'bracketright',
+    '^': 'asciicircum', '_': 'underscore', '`': 'grave', '{': 'braceleft', '|': 'bar',
+    '}': 'braceright', '~': 'asciitilde',
+}
+
+def xdotool_name(key: str) -> str:
+    if key in xdotool_names: return xdotool_names[key]
+    if re.fullmatch('f[0-9]+', key): return key.upper()
+    return key
+
+class XdotoolBackend:
+    # one xdotool process per batch
+
+    def __init__(self, delay: float) -> None:
+        self.delay = str(int(delay * 1000)) # in milliseconds
+
+    def type(self, text: str) -> None:
+        subprocess.run(['xdotool', 'type', '--delay', self.delay, '--', text])
+
+    def keys(self, events: List[Event]) -> None:
+        args = ['xdotool']
+        for down, group in itertools.groupby(events, lambda e: e[1]):
+            args += ['keydown' if down else 'keyup', '--delay', self.delay]
+            args += [xdotool_name(key) for key, _ in group]
+        subprocess.run(args)
+
+class RecordingBackend:
+    # for tests: prints each batch instead of injecting it
+
+    def type(self, text: str) -> None:
+        util.print_line('type ' + text)
+
+    def keys(self, events: List[Event]) -> None:
+        util.print_line(' '.join(('+' if down else '-') + key for key, down in events))
+
+def make_backend(spec: str, delay: float) -> Any:
+    # spec is one of: auto (xdotool if possible, otherwise pyautogui), xdotool, pyautogui, record;
+    # delay is the time between events, in seconds
+    if spec == 'record': return RecordingBackend()
+    if spec == 'xdotool': return XdotoolBackend(delay)
+    if spec == 'pyautogui': return PyautoguiBackend(delay)
+    if shutil.which('xdotool') and os.environ.get('DISPLAY'):
+        return XdotoolBackend(delay)
+    return PyautoguiBackend(delay)
@@ -0,0 +1,141 @@
+# Child processes, run on an asyncio event loop in a thread of its own, so
+# that any thread can wait for them with a timeout (or until canceled), long
+# output can be streamed as it arrives, and only so many run at once.
+
+import asyncio
+import concurrent.futures
+import os
+import signal
+import threading
+from typing import Callable, List, Optional, Sequence, Union
+
+class Result:
+
+    def __init__(self) -> None:
+        self.returncode: Optional[int] = None # None if it timed out or was canceled
+        self.chunks: List[bytes] = [] # of output, at most max_output bytes in total
+        self.size = 0
+        self.truncated = False # whether there was more output than that
+        self.timed_out = False
+        self.canceled = False
+
+    @property
+    def output(self) -> str:
+        return b''.join(self.chunks).decode('utf-8', 'replace')
+
+class Runner:
+
+    def __init__(self, max_children: int = 8, max_output: int = 1 << 20) -> None:
+        self.max_children = max_children
+        self.max_output = max_output # bytes of output kept per child
+        self.loop: Optional[asyncio.AbstractEventLoop] = None # started on first use
+        self.lock = threading.Lock()
+        self.spawned = 0
+        self.running = 0
+        self.max_running = 0
+        self.timeouts = 0
+
+    def start(self) -> asyncio.AbstractEventLoop:
+        with self.lock:
+            if self.loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, daemon=True).start()
+                async def make_slots() -> asyncio.Semaphore:
+                    return asyncio.Semaphore(self.max_children)
+                self.slots = asyncio.run_coroutine_threadsafe(make_slots(), loop).result()
+                self.loop = loop
+            return self.loop
+
+    def run(self, args: Union[str, Sequence[str]], timeout: Optional[float] = None,
+            on_lines: Optional[Callable[[List[str]], None]] = None,
+            canceled: Optional[Callable[[], bool]] = None) -> Result:
+        # args is a shell command if it's a string; on_lines is called (in the
+        # event loop's thread) with the lines of output as they arrive
+        r = Result()
+        f = asyncio.run_coroutine_threadsafe(self.run_async(r, args, timeout, on_lines), self.start())
+        while True:
+            try:
+                f.result(timeout=(None if canceled is None else 0.1))
+                return r
+            except concurrent.futures.TimeoutError:
+                if canceled is not None and canceled(): f.cancel() # kills the child
+            except concurrent.futures.CancelledError:
+                r.canceled = True
+                return r
+
+    def run_all(self, commands: Sequence[Union[str, Sequence[str]]], timeout: Optional[float] = None) -> List[Result]:
+        # runs them concurrently (as far as max_children allows), each with the given timeout
+        rs = [Result() for _ in commands]
+        async def run_them() -> None:
+            await asyncio.gather(*[self.run_async(r, c, timeout, None) for r, c in zip(rs, commands)])
+        asyncio.run_coroutine_threadsafe(run_them(), self.start()).result()
+        return rs
+
+    def spawn(self, args: Sequence[str]) -> None:
+        # for programs that aren't waited for (and so don't count towards
+        # max_children); only waits until they're started
+        asyncio.run_coroutine_threadsafe(self.spawn_async(args), self.start()).result()
+
+    async def spawn_async(self, args: Sequence[str]) -> None:
+        p = await asyncio.create_subprocess_exec(*args,
+            stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.DEVNULL)
+        asyncio.ensure_future(p.wait()) # so that it gets reaped
+
+    async def run_async(self, r: Result, args: Union[str, Sequence[str]], timeout: Optional[float],
+                        on_lines: Optional[Callable[[List[str]], None]]) -> None:
+        async with self.slots:
+            # in a session of its own, so that whatever it starts can be killed along with it
+            if isinstance(args, str):
+                p = await asyncio.create_subprocess_shell(args,
+                    stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.DEVNULL, start_new_session=True)
+            else:
+                p = await asyncio.create_subprocess_exec(*args,
+                    stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.DEVNULL, start_new_session=True)
+            with self.lock:
+                self.spawned += 1
+                self.running += 1
+                self.max_running = max(self.max_running, self.running)
+            async def finish() -> int:
+                # the timeout covers both, since a child may close its output and go on running
+                await self.collect(r, p, on_lines)
+                return await p.wait()
+            try:
+                r.returncode = await asyncio.wait_for(finish(), timeout)
+            except asyncio.TimeoutError:
+                r.timed_out = True
+                with self.lock: self.timeouts += 1
+            finally:
+                with self.lock: self.running -= 1
+                if r.returncode is None:
+                    try: os.killpg(p.pid, signal.SIGKILL)
+                    except ProcessLookupError: pass
+                    await asyncio.shield(p.wait())
+
+    async def collect(self, r: Result, p: asyncio.subprocess.Process,
+                      on_lines: Optional[Callable[[List[str]], None]]) -> None:
+        assert p.stdout is not None # it's a pipe
+        partial = b''
+        while True:
+            chunk = await p.stdout.read(1 << 16)
+            if not chunk: break
+            room = self.max_output - r.size
+            if len(chunk) > room: r.truncated = True
+            if room > 0:
+                r.chunks.append(chunk[:room])
+                r.size += len(r.chunks[-1])
+            if on_lines is not None:
+                *lines, partial = (partial + chunk).split(b'\n')
+                if len(partial) > self.max_output: lines.append(partial); partial = b''
+                if lines: on_lines([line.decode('utf-8', 'replace') for line in lines])
+        if on_lines is not None and partial: on_lines([partial.decode('utf-8', 'replace')])
+
+    def statistics(self) -> str:
+        with self.lock:
+            return (str(self.spawned) + ' spawned, ' + str(self.running) + ' running (max ' +
+                str(self.max_running) + ' of ' + str(self.max_children) + '), ' +
+                str(self.timeouts) + ' timed out')
+
+runner = Runner()
@@ -2,26 +2,31 @@
 
 set -ev
 
-if [ "$#" -ne 1 ]; then
+if [ "$#" -eq 0 ]; then
     expected=/tmp/evc-tests-expected-output
     actual=/tmp/evc-tests-actual-output
     grep -oP "^ *(#[>]|t) \K.*" tests.sh > $expected
-    ./tests.sh output > $actual
-    diff -u $expected $actual
+    rm -rf htmlcov .coverage*
+    for engine in linear trie; do
+        ./tests.sh output $engine > $actual
+        diff -u $expected $actual
+    done
+    python3-coverage combine
+    python3-coverage html
     exit
 fi
 
+engine=${2:-linear}
+
 function run-covered() {
-    python3-coverage run --source ecl,eclbuiltins,execute,eclcompletion,util --parallel-mode execute.py $*
+    python3-coverage run --source actions,config,ecl,eclbuiltins,execute,eclcompletion,feedback,keys,subprocesses,util,windows --parallel-mode execute.py $*
 }
 
 function t() {
     echo $*
-    run-covered --configdir=example_config --prompt=False --dryrun --volume=0 --color=False $*  | grep -v -e '^$'
+    run-covered --configdir=example_config --engine=$engine --prompt=False --dryrun --volume=0 --color=False $*  | grep -v -e '^$'
 }
 
-rm -rf htmlcov .coverage*
-
 ########################### TEST CASES: ###########################
 
 echo computer print hello | run-covered --configdir=example_config > /dev/null
@@ -106,7 +111,7 @@ t computer define say lol
 t computer define print lol
     #> print <word>+ = 
     #>     def cmd_print(ctx, _, s):
-    #>         print(ctx['ecl'].colored(' '.join(util.split_expansion(s)), 'magenta'))
+    #>         util.print_line(ctx['ecl'].colored(' '.join(util.split_expansion(s)), 'magenta'))
 
 t --modes=zsh 3 times press up
     #> pressing up
@@ -202,5 +207,258 @@ t --modes=test-aliases ding
     #> error: expected a <vdir>:
     #>   up (1) / down (2)
 
-python3-coverage combine
-python3-coverage html
+# FIRST sets of types
+t computer builtin first set of direction
+    #> <hdir> / <vdir> / down / left / right / up
+t computer builtin first set of target
+    #> <direction> / <hdir> / <nextprev> / <screen> / <vdir> / down / frame / germany / india / left / mexico / new / next / previous / right / up / ...
+
+# config files are only reloaded when their content changes
+rm -rf /tmp/evc-test-config && cp -r example_config /tmp/evc-test-config
+cp example_config/modes.yaml /tmp/evc-test-modes.yaml
+(cat example_config/numbers.yaml; echo "'nil': '0'") > /tmp/evc-test-numbers.yaml
+(echo 'builtin config reloads'
+    echo 'builtin execute cp /tmp/evc-test-modes.yaml /tmp/evc-test-config/modes.yaml'; sleep 1; echo 'builtin config reloads'
+    echo 'builtin execute cp /tmp/evc-test-numbers.yaml /tmp/evc-test-config/numbers.yaml'; sleep 1; echo 'builtin config reloads') \
+    | run-covered --configdir=/tmp/evc-test-config --engine=$engine --modes=computer --prompt=False --volume=0 --color=False
+    #> 0
+    #> 0
+    #> 1
+
+# misrecognitions (replacements.yaml) and numbers (numbers.yaml) in input lines
+echo 'computer two times print a scape and of' \
+    | run-covered --configdir=example_config --engine=$engine --prompt=False --volume=0 --color=False
+    #> escape end of
+    #> escape end of
+
+# custom input pipeline (pipeline.yaml)
+rm -rf /tmp/evc-test-pipeline && cp -r example_config /tmp/evc-test-pipeline
+printf '%s\n' '- replacements' '- drop: [please]' "- fold: {exclamation: '!'}" > /tmp/evc-test-pipeline/pipeline.yaml
+printf '%s\n' 'computer please print hello please exclamation' 'computer builtin pipeline statistics' \
+    | run-covered --configdir=/tmp/evc-test-pipeline --engine=$engine --prompt=False --volume=0 --color=False \
+    | sed 's/, [0-9.]* ms$//'
+    #> hello !
+    #> replacements: 2 runs
+    #> drop: 2 runs
+    #> fold: 2 runs
+printf '%s\n' '- drop-leading' > /tmp/evc-test-pipeline/pipeline.yaml
+echo 'computer print hello' | run-covered --configdir=/tmp/evc-test-pipeline --engine=$engine --prompt=False --volume=0 --color=False \
+    | grep -v '^$'
+    #> error: invalid config: pipeline.yaml: drop-leading needs a list
+printf '%s\n' '- drop: [please]' '  fold: {exclamation: "!"}' > /tmp/evc-test-pipeline/pipeline.yaml
+echo 'computer print hello' | run-covered --configdir=/tmp/evc-test-pipeline --engine=$engine --prompt=False --volume=0 --color=False \
+    | grep -v '^$'
+    #> error: invalid config: pipeline.yaml: not a single stage: {'drop': ['please'], 'fold': {'exclamation': '!'}}
+
+# auto-enabling modes as the active window changes (using the fake window tracker)
+rm -rf /tmp/evc-test-windows && cp -r example_config /tmp/evc-test-windows
+printf '%s\n' '' 'fake-editor:' "    auto-enable: { for-suffixes: [' - FakeEdit'] }" >> /tmp/evc-test-windows/modes.yaml
+printf '%s\n' 'notes - FakeEdit' > /tmp/evc-test-window
+(echo 'builtin get active modes'; sleep 1; echo 'other' > /tmp/evc-test-window; sleep 1; echo 'builtin get active modes') \
+    | run-covered --configdir=/tmp/evc-test-windows --windows=fake:/tmp/evc-test-window --modes=computer --prompt=False --volume=0 --color=False
+    #> computer control default text-entry fake-editor
+    #> computer control default text-entry
+
+# auto-enabling modes by the processes under the active window
+printf '%s\n' '' 'fake-sleeper:' "    auto-enable: { for-leaf-applications: sleep }" >> /tmp/evc-test-windows/modes.yaml
+bash -c 'sleep 5; true' & printf '\n%s\n' $! > /tmp/evc-test-window
+printf '%s\n' 'builtin get active modes' 'builtin window processes' \
+    | run-covered --configdir=/tmp/evc-test-windows --windows=fake:/tmp/evc-test-window --modes=computer --prompt=False --volume=0 --color=False \
+    | sed 's/ (pid: .*//; /^$/d'
+    #> computer control default text-entry fake-sleeper
+    #>   bash
+    #>    └ sleep
+kill %%
+
+# the active window is only looked at again once what we know is older than --window-ttl
+for ttl in 1000 0; do
+    printf '%s\n' 'computer print a' 'computer print b' 'builtin window statistics' \
+        | run-covered --configdir=example_config --windows=fake:/tmp/evc-test-window --window-ttl=$ttl --prompt=False --volume=0 --color=False
+done
+    #> a
+    #> b
+    #> 1 snapshots, 3 utterances
+    #> a
+    #> b
+    #> 4 snapshots, 3 utterances
+
+# delay between lines arriving and being evaluated
+printf '%s\n' 'computer print hello' 'computer builtin input latency' \
+    | run-covered --configdir=example_config --engine=$engine --prompt=False --volume=0 --color=False \
+    | sed 's/, mean .*//'
+    #> hello
+    #> 2 lines
+
+# actions run in order, off the input loop, and 'stop actions' skips the ones still pending
+# (the pause lets the executor start the first line, so it's the one being stopped)
+{ printf '%s\n' 'builtin execute sleep 1 ; builtin print a' 'builtin print b'; sleep 0.3
+  printf '%s\n' 'builtin stop actions' 'builtin print c' 'computer 2 times print d' 'builtin action statistics'; } \
+    | run-covered --configdir=example_config --engine=$engine --modes=computer --prompt=False --volume=0 --color=False \
+    | sed 's/, mean .*//; s/^queue depth .*/queue depth/'
+    #> c
+    #> d
+    #> d
+    #> queue depth
+    #> cmd_execute: 1 runs
+    #> cmd_print: 1 runs
+    #> cmd_stop_actions: 1 runs
+    #> cmd_times_cmd: 1 runs
+
+# but lines after a stateful action, like set, aren't matched until it has run
+rm -rf /tmp/evc-test-vars && cp -r example_config /tmp/evc-test-vars
+printf '%s\n' '' 'vars:' '    slowly set <word> <word>: builtin execute sleep 0.3 ; builtin set $2 $3' \
+    '    show <word>: builtin print $(builtin get $1)' >> /tmp/evc-test-vars/modes.yaml
+printf '%s\n' 'slowly set x y' 'show x' 'slowly set dictation true' 'hello there' \
+    | run-covered --configdir=/tmp/evc-test-vars --engine=$engine --modes=vars --windows=fake:/tmp/evc-test-nowindow \
+        --keys=record --prompt=False --volume=0 --color=False \
+    | grep -o -e '^y$' -e 'type .*'
+    #> y
+    #> type hello there
+
+# key events are injected in batches (here recorded instead)
+printf '%s\n' 'computer 2 times press control shift t' 'computer press a b' 'computer text hello world' \
+    'builtin keydown alt' 'builtin keyup alt' 'builtin key statistics' \
+    | run-covered --configdir=example_config --engine=$engine --modes=computer --keys=record --prompt=False --volume=0 --color=False \
+    | sed 's/, [0-9]* events\/s$//'
+    #> +ctrl +shift +t -t -shift -ctrl
+    #> +ctrl +shift +t -t -shift -ctrl
+    #> +a -a +b -b
+    #> type hello world
+    #> +alt
+    #> -alt
+    #> 40 events in 6 batches
+
+# subprocesses: output is streamed, and a command that times out is killed along with its children
+printf '#!/bin/sh\necho first\nsleep 10\necho never\n' > /tmp/evc-test-hang
+printf '#!/bin/sh\necho detached\nexec >/dev/null\nsleep 10\n' > /tmp/evc-test-detach
+printf '#!/bin/sh\necho\nseq 200000\necho\n' > /tmp/evc-test-flood
+chmod +x /tmp/evc-test-hang /tmp/evc-test-detach /tmp/evc-test-flood
+printf '%s\n' 'builtin execute /tmp/evc-test-hang' 'builtin execute /tmp/evc-test-detach' 'builtin execute /tmp/evc-test-flood' \
+    'builtin subprocess statistics' \
+    | run-covered --configdir=example_config --engine=$engine --modes=computer --windows=fake:/tmp/evc-test-nowindow \
+        --execute-timeout=2 --prompt=False --volume=0 --color=False \
+    | sed -n '1,5p;$p'
+    #> first
+    #> execute /tmp/evc-test-hang: timed out after 2 s
+    #> detached
+    #> execute /tmp/evc-test-detach: timed out after 2 s
+    #> 1
+    #> 3 spawned, 0 running (max 1 of 8), 2 timed out
+
+# at most --max-children subprocesses run at once
+(for i in $(seq 12); do echo 'builtin asynchronously builtin execute sleep 0.5'; done; sleep 4; echo 'builtin subprocess statistics') \
+    | run-covered --configdir=example_config --engine=$engine --modes=computer --windows=fake:/tmp/evc-test-nowindow \
+        --max-children=4 --prompt=False --volume=0 --color=False \
+    | sort | uniq -c | sed 's/^ *//'
+    #> 12   finished: { builtin execute sleep 0.5 }
+    #> 1 12 spawned, 0 running (max 4 of 4), 0 timed out
+
+# completions commands run concurrently, and their output is cached
+rm -rf /tmp/evc-test-completions && cp -r example_config /tmp/evc-test-completions
+printf '%s\n' '' '<slow-fruit>:' '    forms: <word>' '    completions: sleep 1; echo apple' \
+    '<slow-nut>:' '    forms: <word>' '    completions: sleep 1; echo walnut' '<snack>: <slow-fruit>/<slow-nut>' \
+    'snacks:' '    eat <snack>: builtin print eating $1' >> /tmp/evc-test-completions/modes.yaml
+printf '%s\n' 'eat' 'eat' 'builtin completion statistics' \
+    | run-covered --configdir=/tmp/evc-test-completions --engine=$engine --modes=snacks,computer \
+        --windows=fake:/tmp/evc-test-nowindow --prompt=False --volume=0 --color=False
+    #> error: expected:
+    #> - a <slow-fruit>: apple (1)
+    #> - a <slow-nut>: walnut (2)
+    #> - a <word>
+    #> error: expected:
+    #> - a <slow-fruit>: apple (1)
+    #> - a <slow-nut>: walnut (2)
+    #> - a <word>
+    #> 1 rounds, 2 commands run, 0 timed out, 2 cache hits; 2 searches, 0 out of time
+
+# and searched for in the background, so that later lines' actions needn't wait for them
+printf '%s\n' 'eat' 'print not waiting' \
+    | run-covered --configdir=/tmp/evc-test-completions --engine=$engine --modes=snacks,computer \
+        --windows=fake:/tmp/evc-test-nowindow --prompt=False --volume=0 --color=False
+    #> not waiting
+    #> error: expected:
+    #> - a <slow-fruit>: apple (1)
+    #> - a <slow-nut>: walnut (2)
+    #> - a <word>
+
+# suggestions are only searched for when shown or picked from (the ignored '3' needs neither)
+printf '%s\n' '3' 'builtin completion statistics' 'focus change new' 'yes' 'computer builtin completion statistics' \
+    | run-covered --configdir=example_config --engine=$engine --modes=computer --windows=fake:/tmp/evc-test-nowindow \
+        --dryrun --prompt=False --volume=0 --color=False \
+    | tr '\r' '\n'
+    #> comp> 3
+    #> 0 rounds, 0 commands run, 0 timed out, 0 cache hits; 0 searches, 0 out of time
+    #> error: did you mean 'work space'?
+    #> pressing wmkey d
+    #> pressing wmkey w
+    #> pressing wmkey a
+    #> 0 rounds, 0 commands run, 0 timed out, 0 cache hits; 1 searches, 0 out of time
+
+# suggesting thousands of completions takes one search for all those the config can't tell apart
+printf '%s\n' '<many-files>:' '    forms: <word>' "    completions: seq 2000 | sed s/^/file/" \
+    'many-files:' '    open <many-files> in <vdir>: builtin print opening $1' >> /tmp/evc-test-completions/modes.yaml
+printf '%s\n' 'open' 'open file7' 'builtin completion statistics' \
+    | run-covered --configdir=/tmp/evc-test-completions --engine=$engine --modes=many-files,computer \
+        --windows=fake:/tmp/evc-test-nowindow --prompt=False --volume=0 --color=False \
+    | sed -n '1p;2s/\(.\{60\}\).*/\1/p;$p'
+    #> error: expected:
+    #> - a <many-files>: file1 in ... (1) / file2 in ... (2) / file
+    #> 1 rounds, 1 commands run, 0 timed out, 0 cache hits; 2 searches, 0 out of time
+
+# hundreds of concurrent jobs
+(echo 'builtin 300 times builtin asynchronously builtin print job'; sleep 4; echo 'builtin jobs') \
+    | run-covered --configdir=example_config --engine=$engine --modes=computer --prompt=False --volume=0 --color=False \
+    | sort | uniq -c | sed 's/^ *//; s/ ([0-9.]* s)//'
+    #> 300   finished: { builtin print job }
+    #> 1 300 finished
+    #> 1 No active jobs.
+    #> 300 job
+
+# canceling a job kills its subprocess
+(echo 'builtin asynchronously builtin execute sleep 5'; sleep 0.5; echo 'builtin jobs'; echo 'builtin cancel job 0'; sleep 0.5; echo 'builtin jobs') \
+    | run-covered --configdir=example_config --engine=$engine --modes=computer --prompt=False --volume=0 --color=False \
+    | sed 's/ ([0-9.]* s)//; s/for [0-9.]* s/for/'
+    #> 0: running for: { builtin execute sleep 5 }
+    #>   canceled: { builtin execute sleep 5 }
+    #> No active jobs.
+    #> 1 canceled
+
+# impure functional builtins are called for each substitution, memo or not
+rm -rf /tmp/evc-test-random && cp -r example_config /tmp/evc-test-random
+printf '%s\n' '' 'dice:' '    roll twice: builtin print $(builtin randomint 1000000) $(builtin randomint 1000000)' \
+    >> /tmp/evc-test-random/modes.yaml
+echo 'roll twice' \
+    | run-covered --configdir=/tmp/evc-test-random --engine=$engine --modes=dice --windows=fake:/tmp/evc-test-nowindow \
+        --prompt=False --volume=0 --color=False \
+    | awk '{ print ($1 == $2 ? "same" : "different") }'
+    #> different
+
+# thousands of chained commands don't run into the recursion limit
+(for i in $(seq 3000); do printf 'mode computer ; '; done; echo 'print chain done') \
+    | run-covered --configdir=example_config --engine=$engine --modes=computer --prompt=False --volume=0 --color=False
+    #> chain done
+
+# compiled config cache: cold vs. warm start (timings are printed to stderr); a warm
+# start compiles nothing, also after the cache was written by a module importing execute
+rm -f example_config/.compiled-config.pickle
+time python3 execute.py --configdir=example_config --prompt=False --volume=0 --color=False computer builtin config compiles
+    #> 4
+time python3 execute.py --configdir=example_config --prompt=False --volume=0 --color=False computer builtin config compiles
+    #> 0
+rm -f example_config/.compiled-config.pickle
+python3 -c 'import execute; execute.configdir = "example_config"; execute.load_config()'
+python3 execute.py --configdir=example_config --prompt=False --volume=0 --color=False computer builtin config compiles
+    #> 0
+
+# the trie engine agrees with the linear one on a large synthetic config
+python3 check-engines.py
+    #> 1000 utterances, 0 disagreements
+
+# the tokenizer agrees with the reference implementation it replaced
+python3 check-tokenizer.py
+    #> 20000 strings, 0 disagreements
+
+# confirm_input doesn't wait for its beeps (played here by a fake mixer)
+python3 check-feedback.py
+    #> blocked for under 50 ms, echoed at once, then played: good good good good good bad (none early)
+    #> then played: good good all-good; 9 sounds played, 2 dropped
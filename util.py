@@ -1,9 +1,11 @@
 import shutil
 import re
 import collections
-import subprocess
+import os
+import subprocesses
 import sys
-from typing import Dict, List, Tuple, Optional
+import threading
+from typing import Any, Dict, FrozenSet, List, Set, Tuple, Optional
 
 def escape(s: str) -> str:
     def f(c: str) -> str:
@@ -44,132 +46,235 @@ def indented_and_wrapped(l: List[str], n: int) -> str:
             cur = n
     return r
 
-def process_family(pid):
-    import psutil # type: ignore
-    children = collections.defaultdict(list)
-    for p in psutil.process_iter():
-        try:
-            children[p.ppid()].append(p.pid)
-        except (psutil.NoSuchProcess, psutil.ZombieProcess):
-            pass
-    start = [pid]
-    return pstree_branch(start, children)
-
 terminal_apps = ['urxvt']
 
-def pstree_branch(pids, children, stop_on_terminal=False):
-    import psutil
-    r = {}
-    for pid in pids:
+class ProcessTable:
+    # the parent and name of every running process, updated incrementally:
+    # refresh only reads the details of processes that started or exited since
+    # the last refresh. processes are identified by pid and start time, since
+    # pids get reused (and a reused pid can have a different parent); whether
+    # that happened is only checked for the families asked for (see members).
+
+    def __init__(self) -> None:
+        self.info: Dict[int, Tuple[float, int, str]] = {} # start time, ppid, name
+        self.handles: Dict[int, Any] = {} # psutil.Process objects
+        self.children: Dict[int, Set[int]] = collections.defaultdict(set)
+        self.families: Dict[int, Tuple[List[Tuple[int, float, str]], Dict, List[Tuple[Dict, Any]]]] = {}
+            # per root pid: the processes in the family, the tree, and the nodes with cwds
+
+    def add(self, pid: int) -> None:
+        import psutil # type: ignore
         try:
-            pro = psutil.Process(pid)
-            name = pro.name()
-            if stop_on_terminal and name in terminal_apps: continue
-            b = (pstree_branch(children[pid], children, True) if pid in children else {})
-            b['name'] = name
-            try: b['cwd'] = pro.cwd()
-            except: pass
-            b['pid'] = pid
-            r[pid] = b
-        except psutil.NoSuchProcess:
-            pass
+            p = psutil.Process(pid)
+            with p.oneshot():
+                info = (p.create_time(), p.ppid(), p.name())
+        except psutil.Error:
+            return
+        self.info[pid] = info
+        self.handles[pid] = p
+        self.children[info[1]].add(pid)
+
+    def remove(self, pid: int) -> None:
+        info = self.info.pop(pid, None)
+        if info is not None:
+            self.children[info[1]].discard(pid)
+            del self.handles[pid]
+            self.families.pop(pid, None)
+
+    def refresh(self) -> None:
+        import psutil
+        pids = set(psutil.pids())
+        orphans: List[int] = []
+        for pid in [pid for pid in self.info if pid not in pids]:
+            orphans += self.children.pop(pid, [])
+            self.remove(pid)
+        for pid in orphans: # they got a new parent
+            self.remove(pid)
+            self.add(pid)
+        for pid in pids:
+            if pid not in self.info: self.add(pid)
+
+    def members(self, pid: int, stop_on_terminal: bool, r: List[Tuple[int, float, str]]) -> None:
+        # the processes that process_family shows for pid, in the order it shows them.
+        # names are those at the time the process was added (so an exec goes unnoticed).
+        if pid not in self.info: return
+        if not self.handles[pid].is_running(): # is_running compares start times, so pid may have been reused
+            self.readd(pid)
+            if pid not in self.info: return
+        start, ppid, name = self.info[pid]
+        if stop_on_terminal and name in terminal_apps: return
+        r.append((pid, start, name))
+        actual = children_of(pid)
+        if actual is not None:
+            # new since the last refresh, or reused pids we have under their old parent:
+            for c in actual - self.children.get(pid, set()): self.readd(c)
+        for c in sorted(self.children.get(pid, [])):
+            self.members(c, True, r)
+
+    def readd(self, pid: int) -> None:
+        orphans = self.children.pop(pid, set()) # of the process that had pid before, if any
+        self.remove(pid)
+        self.add(pid)
+        for c in orphans:
+            self.remove(c)
+            self.add(c)
+
+    def family(self, pid: int) -> Dict:
+        self.refresh()
+        members: List[Tuple[int, float, str]] = []
+        self.members(pid, False, members)
+        cached = self.families.get(pid)
+        if cached is None or cached[0] != members:
+            nodes: Dict[int, Dict] = {}
+            tree: Dict = {}
+            for p, _, name in members:
+                node: Dict = {'name': name, 'pid': p}
+                try: node['cwd'] = self.handles[p].cwd()
+                except: pass
+                nodes[p] = node
+                parent = nodes.get(self.info[p][1]) if p != pid else None
+                (tree if parent is None else parent)[p] = node
+            # the branch that cwd_of_branch looks at first; the other cwds are as of now (for print_pstree):
+            with_cwds: List[Tuple[Dict, Any]] = []
+            branch: Optional[Dict] = tree.get(pid)
+            while branch is not None:
+                with_cwds.append((branch, self.handles[branch['pid']]))
+                branch = next((v for v in branch.values() if type(v) is dict), None)
+            cached = (members, tree, with_cwds)
+            self.families[pid] = cached
+        # only the working directories can change without the family changing (and only these matter)
+        for node, handle in cached[2]:
+            try: node['cwd'] = handle.cwd()
+            except: node.pop('cwd', None)
+        return cached[1]
+
+def children_of(pid: int) -> Optional[Set[int]]:
+    # straight from /proc, or None where that isn't possible
+    r: Set[int] = set()
+    try:
+        for tid in os.listdir('/proc/' + str(pid) + '/task'):
+            with open('/proc/' + str(pid) + '/task/' + tid + '/children') as f:
+                r.update(map(int, f.read().split()))
+    except OSError:
+        return None
     return r
 
-def occurs_in_branch(x, processes):
-    for k, v in processes.items():
-        if k == 'name':
-            if v == x: return True
-        elif type(v) is dict and occurs_in_branch(x, v):
-            return True
-    return False
+process_table = ProcessTable()
 
-def cwd_of_branch(processes):
+def process_family(pid: int) -> Dict:
+    return process_table.family(pid)
+
+def cwd_of_branch(processes: Dict) -> Optional[str]:
     for v in processes.values():
         if type(v) is dict:
             t = cwd_of_branch(v)
             if t is not None: return t
     return (processes['cwd'] if 'cwd' in processes else None)
 
-def occurs_as_leaf_in_branch(x, processes):
-    children = False
-    for v in processes.values():
-        if type(v) is dict:
-            children = True
-            if occurs_as_leaf_in_branch(x, v):
-                return True
-    return not children and 'name' in processes and processes['name'] == x
+def application_names(processes: Dict) -> Tuple[FrozenSet[str], FrozenSet[str]]:
+    # the names of all processes in the branch, and of those without children
+    names: Set[str] = set()
+    leaves: Set[str] = set()
+    def visit(node: Dict) -> None:
+        children = False
+        for v in node.values():
+            if type(v) is dict:
+                children = True
+                visit(v)
+        if 'name' in node:
+            names.add(node['name'])
+            if not children: leaves.add(node['name'])
+    visit(processes)
+    return (frozenset(names), frozenset(leaves))
 
-def parse_quoted_string(s: str) -> Tuple[str, str]:
-    s = s[1:] # skip first "
+# the scanners below work on an index into s rather than on ever shorter
+# copies of it, so that tokenizing takes time linear in the length of s.
+
+plain_run = re.compile(r'[^ {}"]+')
+
+def skip_whitespace(s: str, i: int) -> int:
+    while i < len(s) and s[i].isspace(): i += 1
+    return i
+
+def scan_quoted_string(s: str, i: int) -> Tuple[str, int]:
+    i += 1 # skip first "
     x: List[str] = []
     append = x.append
-    while not s.startswith('"'):
-        if s.startswith('\\"'): append('"'); s = s[2:]
-        elif s.startswith('\\\\'): append('\\'); s = s[2:]
-        elif s == '': raise Exception('missing "')
-        else: append(s[0]); s = s[1:]
-    s = s[1:] # skip final "
-    return (''.join(x), s)
+    while not s.startswith('"', i):
+        if s.startswith('\\"', i): append('"'); i += 2
+        elif s.startswith('\\\\', i): append('\\'); i += 2
+        elif i >= len(s): raise Exception('missing "')
+        else: append(s[i]); i += 1
+    return (''.join(x), i + 1) # skip final "
 
-def parse_basic_expression(s: str) -> Tuple[str, str]:
+def scan_basic_expression(s: str, i: int) -> Tuple[str, int]:
     curly_depth = 0
     x: List[str] = []
     append = x.append
-    while s != '':
-        if s[0] == ' ':
+    while i < len(s):
+        c = s[i]
+        if c == ' ':
             if curly_depth == 0: break
             append(' ')
-            s = s[1:]
-        elif s[0] == '}':
+            i += 1
+        elif c == '}':
             if curly_depth == 0:
                 raise Exception("unmatched }")
             curly_depth -= 1
             append('}')
-            s = s[1:]
-        elif s[0] == '{':
+            i += 1
+        elif c == '{':
             curly_depth += 1
             append('{')
-            s = s[1:]
-        elif s[0] == '"':
+            i += 1
+        elif c == '"':
             if curly_depth != 0: append('"')
-            y, s = parse_quoted_string(s)
+            y, i = scan_quoted_string(s, i)
             append(y)
             if curly_depth != 0: append('"')
         else:
-            append(s[0])
-            s = s[1:]
-    return (''.join(x), s)
+            m = plain_run.match(s, i)
+            append(m.group()) # type: ignore
+            i = m.end() # type: ignore
+    return (''.join(x), i)
+
+def parse_quoted_string(s: str) -> Tuple[str, str]:
+    y, i = scan_quoted_string(s, 0)
+    return (y, s[i:])
+
+def parse_basic_expression(s: str) -> Tuple[str, str]:
+    y, i = scan_basic_expression(s, 0)
+    return (y, s[i:])
 
 def try_parse_braced_expr(s: str) -> Optional[Tuple[List[str], str]]:
     if not s.startswith('{'):
         return None
     r: List[str] = []
-    s = s[1:].lstrip()
+    i = skip_whitespace(s, 1)
     append = r.append
-    while not s.startswith('}'):
-        if not s: return None
-        y, s = parse_basic_expression(s)
+    while not s.startswith('}', i):
+        if i >= len(s): return None
+        y, i = scan_basic_expression(s, i)
         if not y: return None
         append(y)
-        s = s.lstrip()
-    return (r, s[1:])
+        i = skip_whitespace(s, i)
+    return (r, s[i+1:])
 
 def split_expansion(s: str) -> List[str]:
-    s = s.lstrip()
+    i = skip_whitespace(s, 0)
     r: List[str] = []
     append = r.append
-    while s:
-        y, s = parse_basic_expression(s)
+    while i < len(s):
+        y, i = scan_basic_expression(s, i)
         append(y)
-        s = s.lstrip()
+        i = skip_whitespace(s, i)
     return r
 
-def simple_subprocess(cmd: str) -> str:
-    p = subprocess.Popen(cmd, shell=True,
-        stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    return p.stdout.read().decode('utf-8').rstrip()
+def simple_subprocess(cmd: str, timeout: float = 5.0) -> str:
+    # the output of a shell command, or as much as it wrote before the timeout
+    return subprocesses.runner.run(cmd, timeout=timeout).output.rstrip()
 
-def print_pstree(t, indent=0):
+def print_pstree(t: Dict, indent: int = 0) -> str:
     r = ''
     pre = ''
     corner = ' └ '
@@ -190,25 +295,26 @@ def italic(s: str) -> str:
     turn_off_italic = "\x1B[23m"
     return turn_on_italic + s + turn_off_italic
 
+output_lock = threading.Lock()
+
+def print_line(s: str) -> None:
+    # for output from concurrent jobs, which print() could interleave, since
+    # it writes the line and its end separately
+    with output_lock:
+        sys.stdout.write(s + '\n')
+        sys.stdout.flush()
+
+def clear_line_code() -> str:
+    return ('\033[2K\033[1G' if sys.stdout.isatty() else '')
+
 def clear_line() -> None:
     if not sys.stdout.isatty(): return
-    sys.stdout.write('\033[2K\033[1G')
+    sys.stdout.write(clear_line_code())
     sys.stdout.flush()
 
 def truncate(s: str, n: int) -> str:
     return (s[:n-3] + '...' if len(s) > n else s)
 
-def get_current_application():
-    current_windowtitle = ''
-    current_windowprocesses = {}
-    active_win = simple_subprocess('xdotool getactivewindow')
-    if active_win != '':
-        current_windowtitle = simple_subprocess('xdotool getwindowname ' + active_win)
-        current_windowpid = simple_subprocess('xdotool getwindowpid ' + active_win)
-        if current_windowpid != '':
-            current_windowprocesses = process_family(int(current_windowpid))
-    return (current_windowtitle, current_windowprocesses)
-
 def ordinal(s: str) -> int:
     return "first second third fourth fifth sixth seventh eighth ninth tenth eleventh".split().index(s)
 
@@ -0,0 +1,156 @@
+# Tracking of the active window (its title and the pid of its process),
+# which determines what modes are auto-enabled.
+#
+# Trackers report changes to a listener. Some only notice changes when
+# polled, which process_lines does when it needs a fresh snapshot of the
+# active window (see window_ttl and idle_refresh in execute.py).
+
+import asyncio
+import util
+from typing import Any, Callable, Optional, Tuple
+
+Window = Tuple[str, Optional[int]] # title, pid
+Listener = Callable[[Window], None]
+
+no_window: Window = ('', None)
+
+class Tracker:
+    # window is the active window as of the latest report to the listener
+
+    window: Window
+
+    def start(self, loop: asyncio.AbstractEventLoop, listener: Listener) -> None:
+        raise NotImplementedError
+
+    def poll(self) -> None:
+        # reports a change, if it notices one only when asked
+        raise NotImplementedError
+
+def xdotool_active_window() -> Window:
+    active_win = util.simple_subprocess('xdotool getactivewindow', timeout=1)
+    if active_win == '': return no_window
+    title = util.simple_subprocess('xdotool getwindowname ' + active_win, timeout=1)
+    pid = util.simple_subprocess('xdotool getwindowpid ' + active_win, timeout=1)
+    return (title, int(pid) if pid.isdigit() else None)
+
+class XdotoolTracker(Tracker):
+    # asks xdotool (three processes) every time it is polled
+
+    def __init__(self) -> None:
+        self.window = no_window
+
+    def start(self, loop: asyncio.AbstractEventLoop, listener: Listener) -> None:
+        self.listener = listener
+        self.poll()
+
+    def poll(self) -> None:
+        w = xdotool_active_window()
+        if w != self.window:
+            self.window = w
+            self.listener(w)
+
+class XlibTracker(Tracker):
+    # keeps a connection to the X server open, and has it tell us when the
+    # active window or its title change, so that polling is a no-op
+
+    def __init__(self) -> None:
+        from Xlib import X, Xatom, display, error # type: ignore
+        self.X = X
+        self.XError = error.XError
+        self.display = display.Display()
+        self.root = self.display.screen().root
+        atom = self.display.intern_atom
+        self.active_atom = atom('_NET_ACTIVE_WINDOW')
+        self.title_atoms = [atom('_NET_WM_NAME'), Xatom.WM_NAME]
+        self.pid_atom = atom('_NET_WM_PID')
+        self.utf8_atom = atom('UTF8_STRING')
+        self.active: Any = None
+        self.window = no_window
+        self.root.change_attributes(event_mask=X.PropertyChangeMask)
+        self.display.flush()
+
+    def start(self, loop: asyncio.AbstractEventLoop, listener: Listener) -> None:
+        self.listener = listener
+        self.follow_active_window()
+        self.report()
+        loop.add_reader(self.display.fileno(), self.handle_events)
+        self.handle_events() # in case some already got queued
+
+    def poll(self) -> None:
+        pass
+
+    def handle_events(self) -> None:
+        # events can also get queued while we wait for replies, hence the loop
+        while self.display.pending_events():
+            active_changed = title_changed = False
+            for _ in range(self.display.pending_events()):
+                e = self.display.next_event()
+                if e.type != self.X.PropertyNotify: continue
+                if e.atom == self.active_atom: active_changed = True
+                elif e.atom in self.title_atoms and self.active is not None and e.window.id == self.active.id:
+                    title_changed = True
+            if active_changed: self.follow_active_window()
+            if active_changed or title_changed: self.report()
+
+    def property(self, win: Any, atom: int, type: int) -> Any:
+        try:
+            p = win.get_full_property(atom, type)
+        except self.XError:
+            return None # e.g. the window is gone
+        return (None if p is None else p.value)
+
+    def follow_active_window(self) -> None:
+        v = self.property(self.root, self.active_atom, self.X.AnyPropertyType)
+        wid = (v[0] if v is not None and len(v) > 0 and v[0] != 0 else None)
+        if wid == (None if self.active is None else self.active.id): return
+        ignore = lambda *_: None
+        if self.active is not None:
+            self.active.change_attributes(event_mask=0, onerror=ignore)
+        self.active = (None if wid is None else self.display.create_resource_object('window', wid))
+        if self.active is not None:
+            self.active.change_attributes(event_mask=self.X.PropertyChangeMask, onerror=ignore)
+        self.display.flush()
+
+    def report(self) -> None:
+        w = no_window
+        if self.active is not None:
+            title = self.property(self.active, self.title_atoms[0], self.utf8_atom)
+            if title is None: title = self.property(self.active, self.title_atoms[1], self.X.AnyPropertyType)
+            if isinstance(title, bytes): title = title.decode('utf-8', 'replace')
+            pid = self.property(self.active, self.pid_atom, self.X.AnyPropertyType)
+            w = (title or '', int(pid[0]) if pid is not None and len(pid) > 0 else None)
+        if w != self.window:
+            self.window = w
+            self.listener(w)
+
+class FakeTracker(Tracker):
+    # for tests: reads the title and pid (one per line) from a file when polled
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.window = no_window
+
+    def start(self, loop: asyncio.AbstractEventLoop, listener: Listener) -> None:
+        self.listener = listener
+        self.poll()
+
+    def poll(self) -> None:
+        try:
+            with open(self.path) as f:
+                lines = f.read().splitlines() + ['', '']
+        except FileNotFoundError:
+            lines = ['', '']
+        w = (lines[0], int(lines[1]) if lines[1].isdigit() else None)
+        if w != self.window:
+            self.window = w
+            self.listener(w)
+
+def make_tracker(spec: str) -> Tracker:
+    # spec is one of: auto (xlib if possible, otherwise xdotool), xlib, xdotool, fake:<file>
+    if spec.startswith('fake:'): return FakeTracker(spec[len('fake:'):])
+    if spec == 'xdotool': return XdotoolTracker()
+    if spec == 'xlib': return XlibTracker()
+    try:
+        return XlibTracker()
+    except Exception:
+        return XdotoolTracker() # e.g. no python-xlib, or no $DISPLAY